@@ -0,0 +1,24 @@
+from django.conf import settings
+from django.core.checks import Error, register
+
+# Caches which workers can't share, each worker sees only what it stored itself
+UNSHARED_CACHES = (
+    'django.core.cache.backends.locmem.LocMemCache',
+    'django.core.cache.backends.dummy.DummyCache',
+)
+
+
+@register()
+def replicas_need_shared_cache(app_configs, **kwargs):
+    '''
+    Reading your own writes relies on app.routers.record_write, which goes through the default cache.
+    With a cache each worker keeps to itself, a write on one worker isn't sticky on the others.
+    '''
+    backend = settings.CACHES['default']['BACKEND']
+    if not settings.DATABASE_REPLICAS or backend not in UNSHARED_CACHES:
+        return []
+    return [Error(
+        f'DATABASE_REPLICAS needs a cache shared between workers, the default cache is {backend}.',
+        hint='Set CACHES to a shared backend such as Redis, Memcached, the database or a file based cache.',
+        id='app.E001',
+    )]
@@ -1,6 +1,35 @@
+import datetime
+
 from django import forms
+from django.utils.timezone import now
+
+from app.money import MAX_AMOUNT
 
 
 class TransactionForm(forms.Form):
-    amount = forms.IntegerField(min_value=0)
+    amount = forms.IntegerField(min_value=0, max_value=MAX_AMOUNT)
     reference_id = forms.UUIDField()
+
+
+class ScheduledTransactionForm(forms.Form):
+    type = forms.ChoiceField(choices=[('deposit', 'Deposit'), ('withdrawal', 'Withdrawal')])
+    amount = forms.IntegerField(min_value=0, max_value=MAX_AMOUNT)
+    next_run_at = forms.DateTimeField()
+    # Seconds or ISO 8601, left out for a one off transaction
+    interval = forms.DurationField(required=False)
+
+    # run_scheduled is meant to run every minute, so more frequent runs would only be caught up on
+    min_interval = datetime.timedelta(minutes=1)
+
+    def clean_next_run_at(self):
+        # Catching up is for runs the scheduler missed, a back dated schedule would be run many times at once
+        next_run_at = self.cleaned_data['next_run_at']
+        if next_run_at < now():
+            raise forms.ValidationError('Ensure this value is not in the past.', code='past')
+        return next_run_at
+
+    def clean_interval(self):
+        interval = self.cleaned_data['interval']
+        if interval is not None and interval < self.min_interval:
+            raise forms.ValidationError('Ensure this value is at least 1 minute.', code='min_value')
+        return interval
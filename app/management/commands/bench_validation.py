@@ -0,0 +1,45 @@
+import json
+import timeit
+import uuid
+
+from django.core.management.base import BaseCommand
+
+from app.forms import TransactionForm
+from app.validation import UUID_RE, customer_xid, transaction_input
+
+
+def form_path(data):
+    form = TransactionForm(data)
+    if not form.is_valid():
+        return json.loads(form.errors.as_json())
+    return form.cleaned_data
+
+
+def validation_path(data):
+    cleaned, errors = transaction_input(data)
+    return errors or cleaned
+
+
+class Command(BaseCommand):
+    help = 'Times the validation of transaction and wallet creation inputs against the Django form and regex it replaced.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=20000)
+
+    def handle(self, *args, **options):
+        iterations = options['iterations']
+        valid = {'amount': '100', 'reference_id': str(uuid.uuid4())}
+        invalid = {'amount': 'not a number', 'reference_id': ''}
+        cases = [
+            ('transaction, valid', lambda: form_path(valid), lambda: validation_path(valid)),
+            ('transaction, invalid', lambda: form_path(invalid), lambda: validation_path(invalid)),
+            # The string matched by the regex was then turned into a UUID when querying by it
+            ('customer_xid', lambda: UUID_RE.match(valid['reference_id']) and uuid.UUID(valid['reference_id']),
+             lambda: customer_xid({'customer_xid': valid['reference_id']})),
+        ]
+        self.stdout.write(f'{"input":<24} {"before us":>10} {"after us":>10} {"speedup":>8}')
+        for name, before, after in cases:
+            before_time = min(timeit.repeat(before, number=iterations, repeat=3)) / iterations
+            after_time = min(timeit.repeat(after, number=iterations, repeat=3)) / iterations
+            self.stdout.write(
+                f'{name:<24} {before_time * 1e6:>10.2f} {after_time * 1e6:>10.2f} {before_time / after_time:>7.1f}x')
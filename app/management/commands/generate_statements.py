@@ -0,0 +1,64 @@
+import datetime
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import django
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections
+from django.utils.timezone import make_aware, now
+
+from app.statements import generate_partition, plan
+
+
+def generate_in_process(*args):
+    try:
+        return generate_partition(*args)
+    finally:
+        connection.close()
+
+
+def month_bounds(month):
+    try:
+        start = datetime.datetime.strptime(month, '%Y-%m')
+    except ValueError:
+        raise CommandError(f'{month} is not a month like 2022-04')
+    end = (start + datetime.timedelta(days=32)).replace(day=1)
+    return make_aware(start), make_aware(end)
+
+
+class Command(BaseCommand):
+    help = '''
+    Writes a statement of every wallet for a month, as JSON lines files of wallet id ranges.
+    Running it again after an interruption picks up where it stopped.
+    '''
+
+    def add_arguments(self, parser):
+        last_month = (now().replace(day=1) - datetime.timedelta(days=1)).strftime('%Y-%m')
+        parser.add_argument('--month', default=last_month, help='Like 2022-04, last month by default.')
+        parser.add_argument('--output-dir', default='statements')
+        parser.add_argument('--partitions', type=int, default=64)
+        parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                            help='Processes to generate partitions in, 1 generates them in this one.')
+
+    def handle(self, *args, **options):
+        start, end = month_bounds(options['month'])
+        output_dir = os.path.join(options['output_dir'], options['month'])
+        os.makedirs(output_dir, exist_ok=True)
+        try:
+            ranges = plan(output_dir, max(options['partitions'], 1), start, end)
+        except ValueError as error:
+            raise CommandError(error)
+        jobs = [(first, last, start, end, output_dir) for first, last in ranges]
+
+        started = time.perf_counter()
+        if options['workers'] <= 1:
+            written = [generate_partition(*job) for job in jobs]
+        else:
+            # Workers open their own connections. The setup is for platforms which spawn rather than fork them.
+            connections.close_all()
+            with ProcessPoolExecutor(options['workers'], initializer=django.setup) as executor:
+                written = list(executor.map(generate_in_process, *zip(*jobs))) if jobs else []
+        self.stdout.write(
+            f'{sum(written)} statements written to {output_dir} in {time.perf_counter() - started:.1f}s, '
+            f'{written.count(0)} of {len(jobs)} partitions had nothing left to write')
@@ -0,0 +1,58 @@
+import subprocess
+import sys
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+# Run in a fresh interpreter, as this one has imported most of it already
+STARTUP = '''
+import os, time
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'bridgechallenge.settings')
+started = time.perf_counter()
+from django.core.wsgi import get_wsgi_application
+get_wsgi_application()
+loaded = time.perf_counter()
+if {warm_up}:
+    from app.warmup import warm_up
+    warm_up()
+print(f'{{(loaded - started) * 1000:.1f}} {{(time.perf_counter() - loaded) * 1000:.1f}}')
+'''
+
+
+def parse_importtime(output):
+    '''[(module, self us, cumulative us)] from the lines python -X importtime writes to stderr'''
+    modules = []
+    for line in output.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, module = line[len('import time:'):].split('|')
+        modules.append((module.strip(), int(self_us), int(cumulative_us)))
+    return modules
+
+
+class Command(BaseCommand):
+    help = 'Reports the slowest imports of get_wsgi_application() in a fresh interpreter, and how long warming up takes.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--top', type=int, default=25)
+        parser.add_argument('--sort', choices=['self', 'cumulative'], default='cumulative',
+                            help='cumulative includes the imports a module makes.')
+        parser.add_argument('--no-warm-up', action='store_true')
+
+    def handle(self, *args, **options):
+        result = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', STARTUP.format(warm_up=not options['no_warm_up'])],
+            # The project is imported from the working directory, whichever directory manage.py was run from
+            capture_output=True, text=True, cwd=settings.BASE_DIR)
+        if result.returncode:
+            raise CommandError(f'Starting the application failed:\n{result.stderr[-2000:]}')
+
+        modules = parse_importtime(result.stderr)
+        column = 1 if options['sort'] == 'self' else 2
+        self.stdout.write(f'{"self ms":>9} {"cumulative ms":>14}  module')
+        for module, self_us, cumulative_us in sorted(modules, key=lambda row: row[column], reverse=True)[:options['top']]:
+            self.stdout.write(f'{self_us / 1000:>9.1f} {cumulative_us / 1000:>14.1f}  {module}')
+
+        loading_ms, warm_up_ms = result.stdout.split()[-2:]
+        self.stdout.write(f'{len(modules)} modules imported, get_wsgi_application() took {loading_ms}ms, '
+                          f'warming up {warm_up_ms}ms')
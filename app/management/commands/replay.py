@@ -0,0 +1,177 @@
+import json
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client, override_settings
+
+from app import metrics
+from app.models import Wallet
+
+
+class EndpointStats:
+    def __init__(self):
+        self.latencies = []
+        self.mismatches = 0
+
+    def add(self, latency, matched):
+        self.latencies.append(latency)
+        if not matched:
+            self.mismatches += 1
+
+    def percentile(self, fraction):
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+class Command(BaseCommand):
+    help = '''
+    Replays a JSON lines request log against the app in this process and reports throughput and latency per endpoint.
+    Each line looks like
+    {"method": "post", "path": "/api/v1/wallet/deposits", "customer_xid": "...", "data": {...},
+     "at": 1.5, "expect_status": 200, "expect": "success"}
+    where customer_xid picks the wallet whose token is sent, at is seconds since the start of the log and
+    expect is the status field of the response. Lines without method and path are skipped.
+    '''
+
+    def add_arguments(self, parser):
+        parser.add_argument('log', nargs='?', default=str(settings.BASE_DIR / 'requests.jsonl'))
+        parser.add_argument('--concurrency', type=int, default=1,
+                            help='Requests in flight at once. With 1 the log is replayed in order, deterministically.')
+        parser.add_argument('--speedup', type=float, default=1.0,
+                            help='Divides the at offsets of the log. 0 replays as fast as possible.')
+        parser.add_argument('--strict', action='store_true',
+                            help='Fail if any response doesn\'t match what the log expects.')
+
+    def handle(self, *args, **options):
+        concurrency = options['concurrency']
+        if concurrency < 1:
+            raise CommandError('--concurrency must be at least 1')
+        self.speedup = options['speedup']
+        self.tokens = {}
+        self.stats = defaultdict(EndpointStats)
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        skipped = 0
+
+        metrics_before = metrics.snapshot()
+        self.started = time.perf_counter()
+        try:
+            # Like the test runner, let the client's testserver host through
+            with open(options['log']) as log, override_settings(ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, 'testserver']):
+                entries = (json.loads(line) for line in log if line.strip())
+                if concurrency == 1:
+                    for entry in entries:
+                        if not self.is_request(entry):
+                            skipped += 1
+                            continue
+                        self.wait_till_due(entry)
+                        self.replay(entry)
+                else:
+                    # Bound the submitted but unfinished requests so the log is streamed rather than read whole
+                    slots = threading.BoundedSemaphore(concurrency * 2)
+                    errors = []
+                    with ThreadPoolExecutor(concurrency) as executor:
+                        for entry in entries:
+                            if not self.is_request(entry):
+                                skipped += 1
+                                continue
+                            self.wait_till_due(entry)
+                            slots.acquire()
+                            future = executor.submit(self.replay_in_thread, entry)
+                            future.add_done_callback(lambda done: self.finished(done, slots, errors))
+                    # Fail like the sequential replay would
+                    if errors:
+                        raise errors[0]
+        except FileNotFoundError:
+            raise CommandError(f'No request log at {options["log"]}')
+        elapsed = time.perf_counter() - self.started
+
+        self.report(elapsed, skipped)
+        for name, count in sorted(metrics.snapshot().items()):
+            if count != metrics_before.get(name, 0):
+                self.stdout.write(f'{name}: {count - metrics_before.get(name, 0)}')
+        mismatches = sum(stats.mismatches for stats in self.stats.values())
+        if options['strict'] and mismatches:
+            raise CommandError(f'{mismatches} responses did not match the log')
+
+    def is_request(self, entry):
+        return isinstance(entry, dict) and 'method' in entry and 'path' in entry
+
+    def wait_till_due(self, entry):
+        if self.speedup <= 0 or 'at' not in entry:
+            return
+        delay = self.started + entry['at'] / self.speedup - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+
+    def finished(self, future, slots, errors):
+        slots.release()
+        if future.exception() is not None:
+            with self.lock:
+                errors.append(future.exception())
+
+    def replay_in_thread(self, entry):
+        try:
+            self.replay(entry)
+        finally:
+            # Each thread has its own connection, which Django won't close for us
+            connection.close()
+
+    def client(self):
+        if not hasattr(self.local, 'client'):
+            # Errors become 500 responses, which are counted as mismatches
+            self.local.client = Client(raise_request_exception=False)
+        return self.local.client
+
+    def token_for(self, customer_xid):
+        if customer_xid not in self.tokens:
+            token = Wallet.objects.filter(owned_by=customer_xid).values_list('token', flat=True).first()
+            if token is None:
+                # The wallet may not have been created yet, look again next time
+                return ''
+            with self.lock:
+                self.tokens[customer_xid] = token
+        return self.tokens[customer_xid]
+
+    def replay(self, entry):
+        method = entry['method'].lower()
+        headers = {}
+        if 'token' in entry:
+            headers['HTTP_AUTHORIZATION'] = f'Token {entry["token"]}'
+        elif 'customer_xid' in entry:
+            headers['HTTP_AUTHORIZATION'] = f'Token {self.token_for(entry["customer_xid"])}'
+
+        begun = time.perf_counter()
+        response = getattr(self.client(), method)(entry['path'], entry.get('data', {}), **headers)
+        latency = time.perf_counter() - begun
+
+        with self.lock:
+            self.stats[f'{method.upper()} {entry["path"]}'].add(latency, self.matches(entry, response))
+
+    def matches(self, entry, response):
+        if 'expect_status' in entry and response.status_code != entry['expect_status']:
+            return False
+        try:
+            body = response.json()
+        except ValueError:
+            return False
+        if not isinstance(body, dict) or set(body) != {'status', 'data'}:
+            return False
+        return 'expect' not in entry or body['status'] == entry['expect']
+
+    def report(self, elapsed, skipped):
+        self.stdout.write(f'{"endpoint":<40} {"count":>7} {"bad":>5} {"req/s":>9} {"p50 ms":>8} {"p95 ms":>8} {"max ms":>8}')
+        for endpoint, stats in sorted(self.stats.items()):
+            count = len(stats.latencies)
+            self.stdout.write(
+                f'{endpoint:<40} {count:>7} {stats.mismatches:>5} {count / elapsed:>9.1f} '
+                f'{stats.percentile(0.5) * 1000:>8.2f} {stats.percentile(0.95) * 1000:>8.2f} '
+                f'{max(stats.latencies) * 1000:>8.2f}')
+        total = sum(len(stats.latencies) for stats in self.stats.values())
+        self.stdout.write(f'{total} requests in {elapsed:.2f}s ({total / elapsed if elapsed else 0:.1f} req/s), '
+                          f'{skipped} lines skipped')
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from app.scheduling import run_due
+
+
+class Command(BaseCommand):
+    help = 'Runs the scheduled transactions which are due, in batches. Run one of these at a time, e.g. every minute.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        statuses = run_due(batch_size=options['batch_size'])
+        if not statuses:
+            self.stdout.write('Nothing due')
+        for status, count in sorted(statuses.items()):
+            self.stdout.write(f'{status}: {count}')
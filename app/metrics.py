@@ -0,0 +1,53 @@
+'''
+Counters of things worth watching, like wallet save conflicts.
+Each process keeps its own counts, and adds them to counters in the cache too, which add up across workers when
+the cache is shared between them. GET /api/v1/metrics shows those.
+'''
+import logging
+import threading
+from collections import Counter
+
+from django.core.cache import cache
+
+logger = logging.getLogger(__name__)
+
+# Counters shown by the metrics view
+EXPORTED = ('wallet.conflicts', 'wallet.conflicts_exhausted')
+
+_lock = threading.Lock()
+_counters = Counter()
+
+
+def _key(name):
+    return f'metrics:{name}'
+
+
+def increment(name, by=1):
+    with _lock:
+        _counters[name] += by
+        count = _counters[name]
+    cache.add(_key(name), 0, timeout=None)
+    try:
+        cache.incr(_key(name), by)
+    except ValueError:
+        # Evicted since it was added
+        cache.set(_key(name), by, timeout=None)
+    logger.debug('%s is %d in this process', name, count)
+
+
+def snapshot():
+    '''The counts of this process'''
+    with _lock:
+        return dict(_counters)
+
+
+def shared_snapshot(names=EXPORTED):
+    '''The counts in the cache, of every worker sharing it'''
+    counts = cache.get_many([_key(name) for name in names])
+    return {name: counts.get(_key(name), 0) for name in names}
+
+
+def reset():
+    with _lock:
+        _counters.clear()
+    cache.delete_many([_key(name) for name in EXPORTED])
@@ -0,0 +1,18 @@
+# Generated by Django 4.0.3 on 2026-10-19 03:49
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0006_remove_transaction_deposited_by'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='wallet',
+            name='version',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
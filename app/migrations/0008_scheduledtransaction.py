@@ -0,0 +1,34 @@
+# Generated by Django 4.0.3 on 2026-10-19 03:52
+
+from django.db import migrations, models
+import django.db.models.deletion
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0007_wallet_version'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ScheduledTransaction',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('schedule_id', models.UUIDField(default=uuid.uuid4)),
+                ('is_withdrawal', models.BooleanField()),
+                ('amount', models.IntegerField()),
+                ('next_run_at', models.DateTimeField()),
+                ('interval', models.DurationField(null=True)),
+                ('is_active', models.BooleanField(default=True)),
+                ('last_run_at', models.DateTimeField(null=True)),
+                ('last_status', models.CharField(blank=True, max_length=16)),
+                ('wallet', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='app.wallet')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='scheduledtransaction',
+            index=models.Index(fields=['is_active', 'next_run_at'], name='app_schedul_is_acti_b20bfd_idx'),
+        ),
+    ]
@@ -0,0 +1,53 @@
+# Generated by Django 4.0.3 on 2026-10-19 03:56
+
+import app.money
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0008_scheduledtransaction'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='transaction',
+            name='currency',
+            field=models.CharField(default=app.money.default_currency, max_length=3),
+        ),
+        migrations.AddField(
+            model_name='wallet',
+            name='currency',
+            field=models.CharField(default=app.money.default_currency, max_length=3),
+        ),
+        migrations.AlterField(
+            model_name='scheduledtransaction',
+            name='amount',
+            field=models.BigIntegerField(),
+        ),
+        migrations.AlterField(
+            model_name='transaction',
+            name='amount',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AlterField(
+            model_name='wallet',
+            name='balance',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.CreateModel(
+            name='SubBalance',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('currency', models.CharField(max_length=3)),
+                ('balance', models.BigIntegerField(default=0)),
+                ('wallet', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='app.wallet')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='subbalance',
+            constraint=models.UniqueConstraint(fields=('wallet', 'currency'), name='unique_wallet_currency'),
+        ),
+    ]
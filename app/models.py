@@ -1,15 +1,35 @@
+import datetime
+import logging
 import random
 import string
 import uuid
 
-from django.db import models
+from django.db import models, transaction
+from django.db.models import F
 from django.utils.timezone import now
 
+from app import metrics
+from app.money import MAX_AMOUNT, default_currency
+
+logger = logging.getLogger(__name__)
+
 
 def token_string():
     return ''.join(random.choices(string.ascii_lowercase + string.digits, k=42))
 
 
+class WalletConflict(Exception):
+    '''The wallet kept changing under us, even after retrying'''
+
+
+class InsufficientBalance(Exception):
+    pass
+
+
+class BalanceLimitExceeded(Exception):
+    '''The balance would go past MAX_AMOUNT'''
+
+
 class Wallet(models.Model):
     wallet_id = models.UUIDField(db_index=True, default=uuid.uuid4)
     owned_by = models.UUIDField(db_index=True, unique=True)
@@ -19,19 +39,28 @@ class Wallet(models.Model):
         default=token_string)
     enabled_at = models.DateTimeField(null=True)
     disabled_at = models.DateTimeField(null=True)
-    balance = models.IntegerField(default=0)
+    # In minor units of currency. Balances in other currencies are SubBalances.
+    balance = models.BigIntegerField(default=0)
+    currency = models.CharField(max_length=3, default=default_currency)
+    # Bumped on every change, so a change based on a stale read can be detected and retried
+    version = models.PositiveIntegerField(default=0)
+
+    max_change_attempts = 5
 
     def as_response(self):
         out = {
             'id': self.wallet_id,
             'owned_by': self.owned_by,
             'status': 'enabled' if self.is_enabled() else 'disabled',
-            'balance': self.balance
+            'balance': self.balance,
+            'currency': self.currency,
+            'balances': self.balances()
         }
         if self.is_enabled():
             out['enabled_at'] = self.enabled_at
         elif self.disabled_at:
             out['disabled_at'] = self.disabled_at
+        return out
 
     @classmethod
     def create(cls, customer_id):
@@ -42,41 +71,130 @@ class Wallet(models.Model):
     def is_enabled(self):
         return self.enabled_at and not self.disabled_at
 
+    def balances(self):
+        '''{currency: balance} of the wallet's own currency and of its SubBalances'''
+        return {self.currency: self.balance, **dict(self.subbalance_set.values_list('currency', 'balance'))}
+
     def enable(self):
         assert not self.is_enabled()
-        self.enabled_at = now()
-        self.disabled_at = None
-        self.save()
+
+        def change():
+            if self.is_enabled():
+                # Someone else enabled it meanwhile
+                return {}
+            return {'enabled_at': now(), 'disabled_at': None}
+        self.change(change)
 
     def disable(self):
         # This is idempotent
-        if not self.disabled_at:
-            self.disabled_at = now()
-            self.save()
-
-    def deposit(self, amount, reference_id):
-        self.balance += amount
-        self.save()
-        return self.transaction_set.create(
-            is_success=True,
-            is_withdrawal=False,
-            reference_id=reference_id,
-            amount=amount
-        )
+        self.change(lambda: {} if self.disabled_at else {'disabled_at': now()})
 
-    def can_withdraw(self, amount):
-        return amount <= self.balance
-
-    def withdraw(self, amount, reference_id):
-        assert self.can_withdraw(amount)
-        self.balance -= amount
-        self.save()
-        return self.transaction_set.create(
-            is_success=True,
-            is_withdrawal=True,
-            reference_id=reference_id,
-            amount=amount
-        )
+    def deposit(self, amount, reference_id, currency=None):
+        currency = currency or self.currency
+
+        def change():
+            if self.balance > MAX_AMOUNT - amount:
+                raise BalanceLimitExceeded
+            return {'balance': self.balance + amount}
+        with transaction.atomic():
+            if currency == self.currency:
+                self.change(change)
+            else:
+                SubBalance.deposit(self.pk, currency, amount)
+            return self.transaction_set.create(
+                is_success=True,
+                is_withdrawal=False,
+                reference_id=reference_id,
+                amount=amount,
+                currency=currency
+            )
+
+    def can_withdraw(self, amount, currency=None):
+        if not currency or currency == self.currency:
+            return amount <= self.balance
+        return SubBalance.objects.filter(wallet_id=self.pk, currency=currency, balance__gte=amount).exists()
+
+    def withdraw(self, amount, reference_id, currency=None):
+        currency = currency or self.currency
+
+        def change():
+            # The balance may have dropped since the caller checked
+            if not self.can_withdraw(amount):
+                raise InsufficientBalance
+            return {'balance': self.balance - amount}
+        with transaction.atomic():
+            if currency == self.currency:
+                assert self.can_withdraw(amount)
+                self.change(change)
+            else:
+                # The update only happens if the balance covers it, so there is nothing to check first
+                SubBalance.withdraw(self.pk, currency, amount)
+            return self.transaction_set.create(
+                is_success=True,
+                is_withdrawal=True,
+                reference_id=reference_id,
+                amount=amount,
+                currency=currency
+            )
+
+    def post_batch(self, entries):
+        '''
+        Posts many (amount, is_withdrawal, reference_id) entries in order with a single balance update.
+        Withdrawals which would overdraw the wallet and deposits which would take it past MAX_AMOUNT are recorded
+        as failed transactions.
+        Returns 'success', 'insufficient' or 'over_limit' for each entry.
+        '''
+        outcomes = []
+
+        def change():
+            outcomes.clear()
+            balance = self.balance
+            for amount, is_withdrawal, _ in entries:
+                if is_withdrawal and amount > balance:
+                    outcomes.append('insufficient')
+                    continue
+                if not is_withdrawal and balance > MAX_AMOUNT - amount:
+                    outcomes.append('over_limit')
+                    continue
+                balance += -amount if is_withdrawal else amount
+                outcomes.append('success')
+            return {'balance': balance} if balance != self.balance else {}
+        with transaction.atomic():
+            self.change(change)
+            Transaction.objects.bulk_create([
+                Transaction(
+                    wallet=self,
+                    is_success=outcome == 'success',
+                    is_withdrawal=is_withdrawal,
+                    reference_id=reference_id,
+                    amount=amount,
+                    currency=self.currency)
+                for (amount, is_withdrawal, reference_id), outcome in zip(entries, outcomes)
+            ])
+        return outcomes
+
+    def change(self, compute):
+        '''
+        Saves the fields returned by compute() only if nobody saved the wallet since we read it.
+        Otherwise the wallet is read again and compute() called again, up to max_change_attempts times.
+        compute() should work out the fields from the current values on self and return {} if there is nothing to do.
+        '''
+        for _ in range(self.max_change_attempts):
+            fields = compute()
+            if not fields:
+                return
+            updated = Wallet.objects.filter(pk=self.pk, version=self.version).update(
+                version=self.version + 1, **fields)
+            if updated:
+                for name, value in fields.items():
+                    setattr(self, name, value)
+                self.version += 1
+                return
+            metrics.increment('wallet.conflicts')
+            self.refresh_from_db(fields=['enabled_at', 'disabled_at', 'balance', 'version'])
+        metrics.increment('wallet.conflicts_exhausted')
+        logger.warning('Gave up saving wallet %s after %d conflicting attempts', self.pk, self.max_change_attempts)
+        raise WalletConflict
 
 
 class Transaction(models.Model):
@@ -88,7 +206,9 @@ class Transaction(models.Model):
     # deposited_by = models.UUIDField(null=True)
     transaction_id = models.UUIDField(default=uuid.uuid4)
     reference_id = models.UUIDField()
-    amount = models.IntegerField(default=0)
+    # In minor units of currency
+    amount = models.BigIntegerField(default=0)
+    currency = models.CharField(max_length=3, default=default_currency)
 
     def as_response(self):
         if self.is_withdrawal:
@@ -99,6 +219,7 @@ class Transaction(models.Model):
                 'withdrawn_by': self.wallet.owned_by,
                 'withdrawn_at': self.transacted_at,
                 'amount': self.amount,
+                'currency': self.currency,
                 'reference_id': self.reference_id
             }
         else:
@@ -109,5 +230,87 @@ class Transaction(models.Model):
                 'deposited_by': self.wallet.owned_by,
                 'deposited_at': self.transacted_at,
                 'amount': self.amount,
+                'currency': self.currency,
                 'reference_id': self.reference_id
             }
+
+
+class SubBalance(models.Model):
+    '''
+    What a wallet holds in a currency other than its own.
+    These are changed with single conditional updates, so they need no version.
+    '''
+    wallet = models.ForeignKey(Wallet, on_delete=models.CASCADE)
+    currency = models.CharField(max_length=3)
+    # In minor units of currency
+    balance = models.BigIntegerField(default=0)
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=['wallet', 'currency'], name='unique_wallet_currency')]
+
+    @classmethod
+    def deposit(cls, wallet_pk, currency, amount):
+        cls.objects.get_or_create(wallet_id=wallet_pk, currency=currency)
+        updated = cls.objects.filter(wallet_id=wallet_pk, currency=currency, balance__lte=MAX_AMOUNT - amount).update(
+            balance=F('balance') + amount)
+        if not updated:
+            raise BalanceLimitExceeded
+
+    @classmethod
+    def withdraw(cls, wallet_pk, currency, amount):
+        updated = cls.objects.filter(wallet_id=wallet_pk, currency=currency, balance__gte=amount).update(
+            balance=F('balance') - amount)
+        if not updated:
+            raise InsufficientBalance
+
+
+class ScheduledTransaction(models.Model):
+    '''
+    A deposit or withdrawal to be made at next_run_at, and every interval after that if one is given.
+    These are run in batches by the run_scheduled command.
+    '''
+    wallet = models.ForeignKey(Wallet, on_delete=models.CASCADE)
+    schedule_id = models.UUIDField(default=uuid.uuid4)
+    is_withdrawal = models.BooleanField()
+    # In minor units of the wallet's currency
+    amount = models.BigIntegerField()
+    next_run_at = models.DateTimeField()
+    # Null for a one off transaction
+    interval = models.DurationField(null=True)
+    is_active = models.BooleanField(default=True)
+    last_run_at = models.DateTimeField(null=True)
+    last_status = models.CharField(max_length=16, blank=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['is_active', 'next_run_at'])]
+
+    def reference_for_run(self):
+        # The same for every attempt at a given run, so the run can be told apart from others
+        return uuid.uuid5(self.schedule_id, self.next_run_at.isoformat())
+
+    def advance(self, status, at, skip_missed=False):
+        '''
+        Moves on to the next run, or with skip_missed to the first one after at, leaving out the runs missed
+        meanwhile.
+        '''
+        self.last_run_at = at
+        self.last_status = status
+        # A non positive interval would never stop being due, so it is run once like a one off
+        if not self.interval or self.interval <= datetime.timedelta(0):
+            self.is_active = False
+            return
+        self.next_run_at += self.interval
+        if skip_missed and self.next_run_at <= at:
+            self.next_run_at += self.interval * ((at - self.next_run_at) // self.interval + 1)
+
+    def as_response(self):
+        return {
+            'id': self.schedule_id,
+            'type': 'withdrawal' if self.is_withdrawal else 'deposit',
+            'amount': self.amount,
+            'next_run_at': self.next_run_at,
+            'interval': self.interval.total_seconds() if self.interval else None,
+            'is_active': self.is_active,
+            'last_run_at': self.last_run_at,
+            'last_status': self.last_status,
+        }
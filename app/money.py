@@ -0,0 +1,64 @@
+'''
+Amounts are kept as integers in the minor unit of their currency, e.g. cents for USD, in 64 bit columns.
+'''
+from decimal import ROUND_HALF_EVEN, Decimal
+
+from django.conf import settings
+from django.db.models import Sum
+
+# The most a balance or an amount can be, what fits in the 64 bit columns
+MAX_AMOUNT = 2 ** 63 - 1
+
+# What sums of amounts are split at, see wide_sum()
+WIDE_SUM_SPLIT = 2 ** 32
+
+# Digits after the decimal point, from ISO 4217
+MINOR_UNITS = {
+    'AUD': 2,
+    'CNY': 2,
+    'EUR': 2,
+    'GBP': 2,
+    'IDR': 2,
+    'INR': 2,
+    'JPY': 0,
+    'KRW': 0,
+    'KWD': 3,
+    'MYR': 2,
+    'SGD': 2,
+    'USD': 2,
+}
+
+
+def default_currency():
+    return settings.WALLET_CURRENCY
+
+
+def wide_sum(name, expression):
+    '''
+    Aggregates for the sum of an amount expression, which may need more than 64 bits while each amount fits.
+    SQLite raises on such sums and casting doesn't help, so the parts above and below WIDE_SUM_SPLIT are summed
+    apart, each far from overflowing. Put them back together with joined_sum(row, name).
+    Relies on / dividing integers to an integer, as SQLite and PostgreSQL do.
+    '''
+    return {
+        f'{name}_high': Sum(expression / WIDE_SUM_SPLIT),
+        f'{name}_low': Sum(expression % WIDE_SUM_SPLIT),
+    }
+
+
+def joined_sum(row, name):
+    '''The sum named name by wide_sum() in a values() row'''
+    return row[f'{name}_high'] * WIDE_SUM_SPLIT + row[f'{name}_low']
+
+
+def convert_totals(totals, rates, to):
+    '''
+    Converts {currency: minor units} totals to minor units of the currency to, and adds them up.
+    rates gives the value of one major unit of each currency in major units of to.
+    Each currency is converted once, so totals should be aggregated per currency first.
+    '''
+    converted = Decimal(0)
+    for currency, amount in totals.items():
+        rate = Decimal(1) if currency == to else Decimal(str(rates[currency]))
+        converted += Decimal(amount) * rate.scaleb(MINOR_UNITS[to] - MINOR_UNITS[currency])
+    return int(converted.quantize(Decimal(1), rounding=ROUND_HALF_EVEN))
@@ -0,0 +1,40 @@
+'''
+Totals for reports, aggregated per currency by the database so only one row per currency comes back.
+The totals may need more than 64 bits, hence wide_sum().
+Combine them into a single currency with app.money.convert_totals.
+'''
+from collections import Counter
+
+from django.db.models import Case, F, When
+
+from app.models import SubBalance, Transaction, Wallet
+from app.money import joined_sum, wide_sum
+
+
+def balances_by_currency(wallets=None):
+    '''{currency: minor units} held across the wallets, in their own currencies and in sub balances'''
+    wallets = Wallet.objects.all() if wallets is None else wallets
+    totals = Counter()
+    for row in wallets.values('currency').annotate(**wide_sum('total', F('balance'))):
+        totals[row['currency']] += joined_sum(row, 'total')
+    sub_balances = SubBalance.objects.filter(wallet__in=wallets.values('pk'))
+    for row in sub_balances.values('currency').annotate(**wide_sum('total', F('balance'))):
+        totals[row['currency']] += joined_sum(row, 'total')
+    return dict(totals)
+
+
+def flows_by_currency(transactions=None):
+    '''{currency: (deposited, withdrawn)} in minor units, of the successful transactions'''
+    transactions = Transaction.objects.all() if transactions is None else transactions
+    rows = (
+        transactions
+        .filter(is_success=True)
+        .values('currency')
+        .annotate(
+            **wide_sum('deposited', Case(When(is_withdrawal=False, then=F('amount')), default=0)),
+            **wide_sum('withdrawn', Case(When(is_withdrawal=True, then=F('amount')), default=0)))
+    )
+    return {
+        row['currency']: (joined_sum(row, 'deposited'), joined_sum(row, 'withdrawn'))
+        for row in rows
+    }
@@ -0,0 +1,57 @@
+import random
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.core.cache import cache
+
+_reading_from_replica = ContextVar('reading_from_replica', default=False)
+
+
+@contextmanager
+def reading_from_replica():
+    '''Reads inside this block go to one of the DATABASE_REPLICAS, if there are any'''
+    reset_token = _reading_from_replica.set(True)
+    try:
+        yield
+    finally:
+        _reading_from_replica.reset(reset_token)
+
+
+def is_reading_from_replica():
+    return _reading_from_replica.get() and bool(settings.DATABASE_REPLICAS)
+
+
+def _sticky_key(token):
+    return f'wallet-wrote:{token}'
+
+
+def record_write(token):
+    '''
+    Keeps the reads of this token on the primary for a while, so it sees its own writes even if the replicas lag.
+    The cache is shared between workers when it is configured to be.
+    '''
+    cache.set(_sticky_key(token), True, timeout=settings.REPLICA_STICKY_SECONDS)
+
+
+def wrote_recently(token):
+    return cache.get(_sticky_key(token), False)
+
+
+class ReplicaRouter:
+    '''
+    Sends reads made inside reading_from_replica() to a replica and everything else to the primary.
+    Views opt into it, as by default a read may be part of a flow which goes on to write.
+    '''
+
+    def db_for_read(self, model, **hints):
+        if is_reading_from_replica():
+            return random.choice(settings.DATABASE_REPLICAS)
+        return 'default'
+
+    def db_for_write(self, model, **hints):
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # The replicas hold the same rows as the primary
+        return True
@@ -0,0 +1,68 @@
+from collections import Counter
+from itertools import groupby
+
+from django.db import transaction
+from django.utils.timezone import now
+
+from app.models import ScheduledTransaction, WalletConflict
+
+# Runs of a recurring transaction which one run_due() catches up on, the rest are skipped
+MAX_CATCH_UP = 31
+
+
+def run_batch(at, batch_size, runs=None):
+    '''
+    Runs up to batch_size scheduled transactions due by at, posting each wallet's share with one balance update.
+    runs counts how often each schedule ran so far, past MAX_CATCH_UP its missed runs are skipped.
+    Returns how many ended with each status.
+    Assumes a single scheduler runs at a time.
+    '''
+    runs = Counter() if runs is None else runs
+    # Postings and the schedules they advance are saved together, so a crash can't run anything twice
+    with transaction.atomic():
+        return _run_batch(at, batch_size, runs)
+
+
+def _run_batch(at, batch_size, runs):
+    due = list(
+        ScheduledTransaction.objects
+        .filter(is_active=True, next_run_at__lte=at)
+        .select_related('wallet')
+        .order_by('next_run_at', 'id')[:batch_size])
+    statuses = Counter()
+    # Sorting is stable, so each wallet's transactions stay in the order they were due
+    for _, scheduled in groupby(sorted(due, key=lambda item: item.wallet_id), key=lambda item: item.wallet_id):
+        scheduled = list(scheduled)
+        wallet = scheduled[0].wallet
+        if not wallet.is_enabled():
+            outcomes = ['disabled'] * len(scheduled)
+        else:
+            try:
+                outcomes = wallet.post_batch([
+                    (item.amount, item.is_withdrawal, item.reference_for_run()) for item in scheduled])
+            except WalletConflict:
+                # Left due, so the next batch tries again
+                statuses['conflict'] += len(scheduled)
+                continue
+        for item, status in zip(scheduled, outcomes):
+            runs[item.pk] += 1
+            item.advance(status, at, skip_missed=runs[item.pk] >= MAX_CATCH_UP)
+            statuses[status] += 1
+    ScheduledTransaction.objects.bulk_update(
+        due, ['next_run_at', 'is_active', 'last_run_at', 'last_status'], batch_size=batch_size)
+    return statuses
+
+
+def run_due(batch_size=500, at=None):
+    '''
+    Runs batches till nothing is due by at, including up to MAX_CATCH_UP runs of recurring transactions
+    missed meanwhile
+    '''
+    at = at or now()
+    statuses = Counter()
+    runs = Counter()
+    while True:
+        batch = run_batch(at, batch_size, runs)
+        statuses.update(batch)
+        if sum(batch.values()) == batch['conflict']:
+            return statuses
@@ -0,0 +1,82 @@
+import time
+
+from django.conf import settings
+
+from app.models import Wallet
+
+
+class WalletState:
+    '''
+    A read only stand-in for Wallet, for handlers which don't modify the wallet.
+    It is filled from values_list() rows, so no model instance is built and the token isn't fetched.
+    '''
+    fields = ('pk', 'wallet_id', 'owned_by', 'enabled_at', 'disabled_at', 'balance', 'currency')
+    __slots__ = (*fields, 'sub_balances')
+
+    def __init__(self, pk, wallet_id, owned_by, enabled_at, disabled_at, balance, currency, sub_balances=None):
+        self.pk = pk
+        self.wallet_id = wallet_id
+        self.owned_by = owned_by
+        self.enabled_at = enabled_at
+        self.disabled_at = disabled_at
+        self.balance = balance
+        self.currency = currency
+        # {currency: balance} of the wallet's SubBalances
+        self.sub_balances = sub_balances or {}
+
+    @classmethod
+    def for_token(cls, token):
+        # The sub balances are joined in, so the wallet comes once for each of them, or once if it has none
+        rows = list(
+            Wallet.objects.filter(token=token)
+            .values_list(*cls.fields, 'subbalance__currency', 'subbalance__balance'))
+        if not rows:
+            raise Wallet.DoesNotExist
+        sub_balances = {currency: balance for *_, currency, balance in rows if currency is not None}
+        return cls(*rows[0][:len(cls.fields)], sub_balances)
+
+    def balances(self):
+        return {self.currency: self.balance, **self.sub_balances}
+
+    # These only read the fields above, so the model's own versions work as is
+    is_enabled = Wallet.is_enabled
+    as_response = Wallet.as_response
+    can_withdraw = Wallet.can_withdraw
+
+
+class WalletStatusRegistry:
+    '''
+    Remembers whether the wallet behind a token is enabled, so requests against disabled wallets
+    can be turned away without a query.
+    It lives in the process, hence a wallet enabled by another worker stays disabled here for up to
+    WALLET_STATUS_REGISTRY_SECONDS, after which the next request reads it again. Turned on by the
+    WALLET_STATUS_REGISTRY setting.
+    '''
+    max_size = 10000
+
+    def __init__(self):
+        # token: (enabled, time.monotonic() when recorded)
+        self._enabled = {}
+
+    @property
+    def active(self):
+        return getattr(settings, 'WALLET_STATUS_REGISTRY', False)
+
+    def record(self, token, enabled):
+        if not self.active:
+            return
+        if len(self._enabled) >= self.max_size and token not in self._enabled:
+            self._enabled.clear()
+        self._enabled[token] = (bool(enabled), time.monotonic())
+
+    def is_disabled(self, token):
+        if not self.active or token not in self._enabled:
+            return False
+        enabled, recorded_at = self._enabled[token]
+        return not enabled and time.monotonic() - recorded_at < settings.WALLET_STATUS_REGISTRY_SECONDS
+
+    def clear(self):
+        self._enabled.clear()
+
+
+status_registry = WalletStatusRegistry()
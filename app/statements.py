@@ -0,0 +1,171 @@
+'''
+Monthly statements: for every wallet, the opening balance, the month's successful transactions and the closing
+balance, per currency.
+Wallets are split into id ranges, each written to its own JSON lines file a wallet at a time. A partition in
+progress has a .partial file, which is picked up where it stopped if the run is interrupted.
+The ranges are kept in a manifest in the output directory, so a rerun works on the same ones however the wallets
+changed meanwhile.
+'''
+import json
+import os
+from collections import defaultdict
+from itertools import groupby
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Case, F, Max, Min, When
+
+from app.models import Transaction, Wallet
+from app.money import joined_sum, wide_sum
+
+CHUNK_SIZE = 2000
+
+
+def partitions(count):
+    '''Splits the wallet ids into up to count (first, last) ranges of about equal width'''
+    bounds = Wallet.objects.aggregate(first=Min('pk'), last=Max('pk'))
+    if bounds['first'] is None:
+        return []
+    width = -(-(bounds['last'] - bounds['first'] + 1) // count)
+    return [
+        (start, min(start + width - 1, bounds['last']))
+        for start in range(bounds['first'], bounds['last'] + 1, width)
+    ]
+
+
+def plan(output_dir, count, start, end):
+    '''
+    The (first, last) ranges for the statements of start to end in output_dir, split into count on the first run.
+    Later runs reuse the ranges in the manifest, adding one for wallets created since.
+    '''
+    path = os.path.join(output_dir, 'manifest.json')
+    bounds = {'from': start.isoformat(), 'to': end.isoformat()}
+    if os.path.exists(path):
+        with open(path) as manifest:
+            manifest = json.load(manifest)
+        if {'from': manifest['from'], 'to': manifest['to']} != bounds:
+            raise ValueError(f'{output_dir} holds statements from {manifest["from"]} to {manifest["to"]}')
+        ranges = [tuple(bound) for bound in manifest['partitions']]
+        covered = ranges[-1][1] if ranges else 0
+        newest = Wallet.objects.aggregate(last=Max('pk'))['last']
+        if newest is None or newest <= covered:
+            return ranges
+        ranges.append((covered + 1, newest))
+    else:
+        ranges = partitions(count)
+    # Written whole or not at all
+    with open(path + '.partial', 'w') as manifest:
+        json.dump({**bounds, 'partitions': ranges}, manifest)
+    os.replace(path + '.partial', path)
+    return ranges
+
+
+def partition_path(output_dir, first, last):
+    return os.path.join(output_dir, f'statements-{first:012d}-{last:012d}.jsonl')
+
+
+def _resume(partial_path):
+    '''The last wallet pk written to a partial file, dropping a line cut off by the interruption'''
+    if not os.path.exists(partial_path):
+        return None
+    last_pk = None
+    complete_length = 0
+    with open(partial_path, 'rb') as partial:
+        for line in partial:
+            if not line.endswith(b'\n'):
+                break
+            last_pk = json.loads(line)['pk']
+            complete_length += len(line)
+    with open(partial_path, 'r+b') as partial:
+        partial.truncate(complete_length)
+    return last_pk
+
+
+def _opening_balances(first, last, start):
+    '''{wallet pk: {currency: balance}} from everything before start, in one aggregate query'''
+    rows = (
+        Transaction.objects
+        .filter(wallet__gte=first, wallet__lte=last, is_success=True, transacted_at__lt=start)
+        .values('wallet_id', 'currency')
+        # Deposits and withdrawals over the years can add up past 64 bits, though the balance fits
+        .annotate(**wide_sum('balance', Case(When(is_withdrawal=True, then=-F('amount')), default=F('amount'))))
+    )
+    balances = defaultdict(dict)
+    for row in rows:
+        balances[row['wallet_id']][row['currency']] = joined_sum(row, 'balance')
+    return balances
+
+
+def generate_partition(first, last, start, end, output_dir):
+    '''
+    Writes the statements of wallets first to last for start <= transacted_at < end.
+    Wallets and transactions are each streamed in pk order and walked together, so only one wallet's
+    transactions are held at a time. Returns the number of statements written by this call.
+    '''
+    path = partition_path(output_dir, first, last)
+    if os.path.exists(path):
+        return 0
+    partial_path = path + '.partial'
+    resume_after = _resume(partial_path)
+    if resume_after is not None:
+        first = resume_after + 1
+
+    opening = _opening_balances(first, last, start)
+    wallets = (
+        Wallet.objects
+        .filter(pk__range=(first, last))
+        .order_by('pk')
+        .values_list('pk', 'wallet_id', 'owned_by', 'currency')
+        .iterator(chunk_size=CHUNK_SIZE))
+    transactions = groupby(
+        Transaction.objects
+        .filter(wallet__gte=first, wallet__lte=last, is_success=True)
+        .filter(transacted_at__gte=start, transacted_at__lt=end)
+        .order_by('wallet_id', 'id')
+        .values_list('wallet_id', 'transaction_id', 'is_withdrawal', 'amount', 'currency', 'reference_id',
+                     'transacted_at')
+        .iterator(chunk_size=CHUNK_SIZE),
+        key=lambda row: row[0])
+    pending = next(transactions, None)
+
+    written = 0
+    with open(partial_path, 'a') as out:
+        for pk, wallet_id, owned_by, currency in wallets:
+            rows = []
+            # Skip transactions of wallets deleted since
+            while pending is not None and pending[0] < pk:
+                pending = next(transactions, None)
+            if pending is not None and pending[0] == pk:
+                rows = list(pending[1])
+                pending = next(transactions, None)
+
+            opening_balances = {currency: 0, **opening.get(pk, {})}
+            balances = defaultdict(int, opening_balances)
+            for _, _, is_withdrawal, amount, row_currency, _, _ in rows:
+                balances[row_currency] += -amount if is_withdrawal else amount
+
+            out.write(json.dumps({
+                'pk': pk,
+                'wallet': wallet_id,
+                'owned_by': owned_by,
+                'from': start,
+                'to': end,
+                'balances': {
+                    code: {'opening': opening_balances.get(code, 0), 'closing': balances[code]}
+                    for code in sorted(balances)
+                },
+                'transactions': [
+                    {
+                        'id': transaction_id,
+                        'type': 'withdrawal' if is_withdrawal else 'deposit',
+                        'amount': amount,
+                        'currency': row_currency,
+                        'reference_id': reference_id,
+                        'at': transacted_at,
+                    }
+                    for _, transaction_id, is_withdrawal, amount, row_currency, reference_id, transacted_at in rows
+                ],
+            }, cls=DjangoJSONEncoder) + '\n')
+            out.flush()
+            written += 1
+    os.replace(partial_path, path)
+    return written
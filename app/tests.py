@@ -1,11 +1,40 @@
+import datetime
 import json
+import multiprocessing
+import os
+import random
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
 import uuid
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from io import StringIO
 
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management import CommandError, call_command
 from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connection, connections
+from django.db.models import Sum
+from django.utils.timezone import now
 
-from django.test import Client, TestCase
+from django.test import Client, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 
-from app.models import Transaction, Wallet
+from app import metrics
+from app.checks import replicas_need_shared_cache
+from app.forms import TransactionForm
+from app.management.commands.profile_startup import parse_importtime
+from app.models import BalanceLimitExceeded, InsufficientBalance, ScheduledTransaction, SubBalance, Transaction, Wallet, WalletConflict
+from app.money import convert_totals
+from app.reporting import balances_by_currency, flows_by_currency
+from app.scheduling import run_due
+from app.state import WalletState, status_registry
+from app.statements import generate_partition, partition_path, partitions, plan
+from app.validation import customer_xid, transaction_input
+from app.warmup import warm_up
 
 
 class AppTestCase(TestCase):
@@ -105,6 +134,7 @@ class WalletEnablingTestCase(AppTestCase):
         wallet = Wallet.create("ea0212d3-abd6-406f-8c67-868e814a2436")
         client = Client(HTTP_AUTHORIZATION=f'Token {wallet.token}' )
         response = client.post('/api/v1/wallet', {})
+        wallet = Wallet.objects.get()
         self.assertResponseJsonEqualsTo(
             response,
             {
@@ -120,6 +150,7 @@ class WalletEnablingTestCase(AppTestCase):
         wallet.disable()
         client = Client(HTTP_AUTHORIZATION=f'Token {wallet.token}' )
         response = client.post('/api/v1/wallet', {})
+        wallet = Wallet.objects.get()
         self.assertResponseJsonEqualsTo(
             response,
             {
@@ -151,6 +182,7 @@ class WalletDisablingTestCase(AppTestCase):
         wallet.enable()
         client = Client(HTTP_AUTHORIZATION=f'Token {wallet.token}')
         response = client.patch('/api/v1/wallet', {})
+        wallet = Wallet.objects.get()
         self.assertResponseJsonEqualsTo(
             response,
             {
@@ -288,4 +320,828 @@ class WalletWithdrawalTestCase(AppTestCase):
                 'status': 'fail',
                 'data': {'wallet': 'Insufficient balance'}
             }
-        )
\ No newline at end of file
+        )
+
+
+class WalletStateTestCase(AppTestCase):
+    def test_wallet_state_behaves_like_wallet(self):
+        wallet = Wallet.create("ea0212d3-abd6-406f-8c67-868e814a2436")
+        wallet.enable()
+        wallet.deposit(100, "aaaaaaaa-abd6-406f-8c67-868e814a2436")
+        state = WalletState.for_token(wallet.token)
+        self.assertEqual(state.pk, wallet.pk)
+        self.assertEqual(state.balance, 100)
+        self.assertEqual(state.is_enabled(), wallet.is_enabled())
+        wallet = Wallet.objects.get()
+        self.assertEqual(
+            state.as_response(),
+            {
+                'id': wallet.wallet_id,
+                'owned_by': uuid.UUID("ea0212d3-abd6-406f-8c67-868e814a2436"),
+                'status': 'enabled',
+                'balance': 100,
+                'currency': 'IDR',
+                'balances': {'IDR': 100},
+                'enabled_at': wallet.enabled_at,
+            }
+        )
+        self.assertEqual(state.as_response(), wallet.as_response())
+        self.assertFalse(hasattr(state, '__dict__'))
+
+    def test_wallet_state_for_unknown_token_raises(self):
+        with self.assertRaises(Wallet.DoesNotExist):
+            WalletState.for_token('not a token')
+
+    def test_fetching_wallet_takes_one_query(self):
+        wallet = Wallet.create("ea0212d3-abd6-406f-8c67-868e814a2436")
+        wallet.enable()
+        client = Client(HTTP_AUTHORIZATION=f'Token {wallet.token}')
+        with self.assertNumQueries(1):
+            client.get('/api/v1/wallet', {})
+
+
+@override_settings(WALLET_STATUS_REGISTRY=True)
+class WalletStatusRegistryTestCase(AppTestCase):
+    def setUp(self):
+        status_registry.clear()
+
+    def tearDown(self):
+        status_registry.clear()
+
+    def test_known_disabled_wallet_is_refused_without_queries(self):
+        wallet = Wallet.create("ea0212d3-abd6-406f-8c67-868e814a2436")
+        client = Client(HTTP_AUTHORIZATION=f'Token {wallet.token}')
+        client.get('/api/v1/wallet', {})
+        with self.assertNumQueries(0):
+            response = client.post(
+                '/api/v1/wallet/deposits',
+                {'amount': 100, 'reference_id': uuid.uuid4()})
+        self.assertResponseJsonEqualsTo(
+            response,
+            {
+                'status': 'fail',
+                'data': {'wallet': 'Wallet is disabled'}
+            }
+        )
+
+    def test_enabling_wallet_updates_registry(self):
+        wallet = Wallet.create("ea0212d3-abd6-406f-8c67-868e814a2436")
+        client = Client(HTTP_AUTHORIZATION=f'Token {wallet.token}')
+        client.get('/api/v1/wallet', {})
+        self.assertTrue(status_registry.is_disabled(wallet.token))
+        client.post('/api/v1/wallet', {})
+        self.assertFalse(status_registry.is_disabled(wallet.token))
+        response = client.get('/api/v1/wallet', {})
+        self.assertEqual(response.json()['status'], 'success')
+
+    def test_disabled_status_expires(self):
+        wallet = Wallet.create("ea0212d3-abd6-406f-8c67-868e814a2436")
+        client = Client(HTTP_AUTHORIZATION=f'Token {wallet.token}')
+        client.get('/api/v1/wallet', {})
+        # Enabled by another worker, which this one's registry doesn't hear of
+        Wallet.objects.filter(pk=wallet.pk).update(enabled_at=now())
+        self.assertTrue(status_registry.is_disabled(wallet.token))
+        with override_settings(WALLET_STATUS_REGISTRY_SECONDS=0):
+            self.assertFalse(status_registry.is_disabled(wallet.token))
+            response = client.get('/api/v1/wallet', {})
+        self.assertEqual(response.json()['status'], 'success')
+        self.assertFalse(status_registry.is_disabled(wallet.token))
+
+
+class ReplayCommandTestCase(AppTestCase):
+    customer_xid = "ea0212d3-abd6-406f-8c67-868e814a2436"
+
+    def replay(self, entries, *args):
+        with tempfile.NamedTemporaryFile('w', suffix='.jsonl') as log:
+            for entry in entries:
+                log.write(json.dumps(entry) + '\n')
+            log.flush()
+            out = StringIO()
+            call_command('replay', log.name, '--speedup', '0', *args, stdout=out)
+        return out.getvalue()
+
+    def test_replaying_log_runs_requests_in_order(self):
+        out = self.replay([
+            {'request_id': 'not a request'},
+            {'method': 'post', 'path': '/api/v1/init', 'data': {'customer_xid': self.customer_xid},
+             'expect': 'success'},
+            {'method': 'post', 'path': '/api/v1/wallet', 'customer_xid': self.customer_xid, 'expect': 'success'},
+            {'method': 'post', 'path': '/api/v1/wallet/deposits', 'customer_xid': self.customer_xid,
+             'data': {'amount': 100, 'reference_id': str(uuid.uuid4())}, 'at': 0.1, 'expect_status': 200},
+            {'method': 'post', 'path': '/api/v1/wallet/deposits', 'customer_xid': self.customer_xid,
+             'data': {'amount': 50, 'reference_id': str(uuid.uuid4())}, 'expect': 'success'},
+        ], '--strict')
+        self.assertEqual(Wallet.objects.get().balance, 150)
+        self.assertIn('POST /api/v1/wallet/deposits', out)
+        self.assertIn('4 requests', out)
+        self.assertIn('1 lines skipped', out)
+
+    def test_concurrent_replay_raises_errors_from_threads(self):
+        with self.assertRaises(AttributeError):
+            self.replay([
+                {'method': 'fetch', 'path': '/api/v1/wallet', 'token': 'unknown'},
+            ], '--concurrency', '2')
+
+    def test_strict_replay_fails_on_unexpected_response(self):
+        with self.assertRaises(CommandError):
+            self.replay([
+                {'method': 'get', 'path': '/api/v1/wallet', 'token': 'unknown', 'expect': 'success'},
+            ], '--strict')
+
+
+class WalletVersioningTestCase(AppTestCase):
+    def setUp(self):
+        metrics.reset()
+        wallet = Wallet.create("ea0212d3-abd6-406f-8c67-868e814a2436")
+        wallet.enable()
+        self.first = Wallet.objects.get()
+        self.second = Wallet.objects.get()
+
+    def test_stale_deposit_is_retried_on_fresh_balance(self):
+        self.first.deposit(100, uuid.uuid4())
+        self.second.deposit(50, uuid.uuid4())
+        wallet = Wallet.objects.get()
+        self.assertEqual(wallet.balance, 150)
+        self.assertEqual(wallet.version, 3)
+        self.assertEqual(metrics.snapshot()['wallet.conflicts'], 1)
+
+    def test_stale_withdrawal_rechecks_balance(self):
+        self.first.deposit(100, uuid.uuid4())
+        self.first.withdraw(100, uuid.uuid4())
+        self.second.balance = 100
+        with self.assertRaises(InsufficientBalance):
+            self.second.withdraw(100, uuid.uuid4())
+        self.assertEqual(Wallet.objects.get().balance, 0)
+        self.assertEqual(Transaction.objects.count(), 2)
+
+    def test_stale_status_change_keeps_balance(self):
+        self.first.deposit(100, uuid.uuid4())
+        self.second.disable()
+        wallet = Wallet.objects.get()
+        self.assertEqual(wallet.balance, 100)
+        self.assertIsNotNone(wallet.disabled_at)
+
+    def test_giving_up_after_max_attempts(self):
+        self.first.deposit(100, uuid.uuid4())
+        self.second.max_change_attempts = 1
+        with self.assertRaises(WalletConflict), self.assertLogs('app.models', 'WARNING'):
+            self.second.deposit(50, uuid.uuid4())
+        self.assertEqual(Wallet.objects.get().balance, 100)
+        self.assertEqual(Transaction.objects.count(), 1)
+        self.assertEqual(metrics.snapshot()['wallet.conflicts_exhausted'], 1)
+
+    def test_conflict_counts_are_shown_by_metrics_view(self):
+        self.first.deposit(100, uuid.uuid4())
+        self.second.deposit(50, uuid.uuid4())
+        response = Client().get('/api/v1/metrics')
+        self.assertResponseJsonEqualsTo(
+            response,
+            {
+                'status': 'success',
+                'data': {'metrics': {'wallet.conflicts': 1, 'wallet.conflicts_exhausted': 0}}
+            }
+        )
+
+
+def move_money(wallet_pk, amount, is_withdrawal):
+    '''
+    Does what the deposit and withdrawal views do with a freshly read wallet.
+    Runs in pool threads and processes, so it closes the connection it opened.
+    '''
+    try:
+        wallet = Wallet.objects.get(pk=wallet_pk)
+        # Stand in for the work a view does between reading and changing the wallet, so others get in between
+        time.sleep(0.001)
+        try:
+            if not is_withdrawal:
+                wallet.deposit(amount, uuid.uuid4())
+            elif wallet.can_withdraw(amount):
+                wallet.withdraw(amount, uuid.uuid4())
+            else:
+                return 'insufficient'
+        except InsufficientBalance:
+            return 'insufficient'
+        except WalletConflict:
+            return 'conflict'
+        return 'done'
+    finally:
+        connection.close()
+
+
+class WalletStressTestCase(TransactionTestCase):
+    '''
+    Deposits and withdraws concurrently and checks no update was lost.
+    STRESS_OPERATIONS sets how many operations each test runs.
+    '''
+    operations = int(os.environ.get('STRESS_OPERATIONS', 300))
+    workers = 8
+
+    def create_wallets(self, count):
+        pks = []
+        for _ in range(count):
+            wallet = Wallet.create(uuid.uuid4())
+            wallet.enable()
+            pks.append(wallet.pk)
+        return pks
+
+    def jobs(self, pks):
+        # Seeded so a failure can be reproduced, withdrawals slightly outnumber deposits to hit empty wallets
+        rng = random.Random(42)
+        return [(rng.choice(pks), rng.randint(1, 100), rng.random() < 0.55) for _ in range(self.operations)]
+
+    def run_jobs(self, executor, pks):
+        metrics.reset()
+        started = time.perf_counter()
+        outcomes = list(executor.map(move_money, *zip(*self.jobs(pks))))
+        elapsed = time.perf_counter() - started
+        sys.stderr.write(f'\n{self.id()}: {len(outcomes)} operations in {elapsed:.2f}s '
+                         f'({len(outcomes) / elapsed:.0f}/s), {outcomes.count("done")} done, '
+                         f'{outcomes.count("insufficient")} insufficient, '
+                         f'{outcomes.count("conflict")} gave up on conflicts, '
+                         # Only counted for threads, worker processes count in their own memory
+                         f'{metrics.snapshot().get("wallet.conflicts", 0)} retries in this process\n')
+        self.assertEqual(Transaction.objects.count(), outcomes.count('done'))
+
+    def assertBalancesMatchTransactions(self, pks):
+        for wallet in Wallet.objects.filter(pk__in=pks):
+            running = 0
+            # Transactions are inserted while the wallet row is held, so id order is the order of balance changes
+            for amount, is_withdrawal in wallet.transaction_set.order_by('id').values_list('amount', 'is_withdrawal'):
+                running += -amount if is_withdrawal else amount
+                self.assertGreaterEqual(running, 0)
+            self.assertEqual(wallet.balance, running)
+            totals = wallet.transaction_set.values('is_withdrawal').annotate(total=Sum('amount'))
+            self.assertEqual(
+                wallet.balance,
+                sum(-row['total'] if row['is_withdrawal'] else row['total'] for row in totals))
+
+    def test_threads_on_one_wallet(self):
+        pks = self.create_wallets(1)
+        with ThreadPoolExecutor(self.workers) as executor:
+            self.run_jobs(executor, pks)
+        self.assertBalancesMatchTransactions(pks)
+
+    def test_threads_on_many_wallets(self):
+        pks = self.create_wallets(10)
+        with ThreadPoolExecutor(self.workers) as executor:
+            self.run_jobs(executor, pks)
+        self.assertBalancesMatchTransactions(pks)
+
+    def test_processes_on_one_wallet(self):
+        pks = self.create_wallets(1)
+        # Children must open their own connections rather than share ours
+        connections.close_all()
+        with ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('fork')) as executor:
+            self.run_jobs(executor, pks)
+        self.assertBalancesMatchTransactions(pks)
+
+    def test_processes_on_many_wallets(self):
+        pks = self.create_wallets(10)
+        connections.close_all()
+        with ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('fork')) as executor:
+            self.run_jobs(executor, pks)
+        self.assertBalancesMatchTransactions(pks)
+
+
+@override_settings(DATABASE_REPLICAS=['replica'])
+class ReplicaRoutingTestCase(TransactionTestCase):
+    databases = {'default', 'replica'}
+
+    def setUp(self):
+        cache.clear()
+        self.wallet = Wallet.create("ea0212d3-abd6-406f-8c67-868e814a2436")
+        self.wallet.enable()
+        self.client = Client(HTTP_AUTHORIZATION=f'Token {self.wallet.token}')
+
+    def tearDown(self):
+        cache.clear()
+
+    def get_wallet(self):
+        with CaptureQueriesContext(connections['default']) as primary, \
+                CaptureQueriesContext(connections['replica']) as replica:
+            response = self.client.get('/api/v1/wallet', {})
+        self.assertEqual(response.json()['status'], 'success')
+        return len(primary), len(replica)
+
+    def test_fetching_wallet_reads_from_replica(self):
+        self.assertEqual(self.get_wallet(), (0, 1))
+
+    def test_fetching_wallet_after_writing_reads_from_primary(self):
+        self.client.post('/api/v1/wallet/deposits', {'amount': 100, 'reference_id': uuid.uuid4()})
+        self.assertEqual(self.get_wallet(), (1, 0))
+
+    @override_settings(REPLICA_STICKY_SECONDS=0.1)
+    def test_reads_go_back_to_replica_after_sticky_window(self):
+        self.client.post('/api/v1/wallet/deposits', {'amount': 100, 'reference_id': uuid.uuid4()})
+        time.sleep(0.2)
+        self.assertEqual(self.get_wallet(), (0, 1))
+
+    @override_settings(WALLET_STATUS_REGISTRY=True)
+    def test_replica_reads_are_not_recorded_in_status_registry(self):
+        status_registry.clear()
+        self.addCleanup(status_registry.clear)
+        self.client.patch('/api/v1/wallet', {})
+        cache.clear()
+        status_registry.clear()
+        self.client.get('/api/v1/wallet', {})
+        self.assertFalse(status_registry.is_disabled(self.wallet.token))
+
+    def test_writes_go_to_primary(self):
+        with CaptureQueriesContext(connections['replica']) as replica:
+            self.client.post('/api/v1/wallet/deposits', {'amount': 100, 'reference_id': uuid.uuid4()})
+            self.client.patch('/api/v1/wallet', {})
+        self.assertEqual(len(replica), 0)
+        self.assertEqual(Wallet.objects.get().balance, 100)
+
+    def test_replicas_need_shared_cache(self):
+        self.assertEqual([error.id for error in replicas_need_shared_cache(None)], ['app.E001'])
+        with override_settings(CACHES={'default': {
+                'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache', 'LOCATION': '/tmp/wallet-cache'}}):
+            self.assertEqual(replicas_need_shared_cache(None), [])
+
+
+class ScheduledTransactionTestCase(AppTestCase):
+    def setUp(self):
+        self.wallet = Wallet.create("ea0212d3-abd6-406f-8c67-868e814a2436")
+        self.wallet.enable()
+        self.start = now() - datetime.timedelta(days=2, hours=1)
+
+    def schedule(self, amount, is_withdrawal=False, interval=None, wallet=None):
+        return ScheduledTransaction.objects.create(
+            wallet=wallet or self.wallet,
+            amount=amount,
+            is_withdrawal=is_withdrawal,
+            next_run_at=self.start,
+            interval=interval)
+
+    def test_posting_batch_updates_balance_once_and_fails_overdrafts(self):
+        outcomes = self.wallet.post_batch([
+            (100, False, uuid.uuid4()),
+            (150, True, uuid.uuid4()),
+            (60, True, uuid.uuid4()),
+        ])
+        self.assertEqual(outcomes, ['success', 'insufficient', 'success'])
+        wallet = Wallet.objects.get()
+        self.assertEqual(wallet.balance, 40)
+        self.assertEqual(wallet.version, 2)
+        self.assertEqual(
+            list(Transaction.objects.order_by('id').values_list('is_success', flat=True)),
+            [True, False, True])
+
+    def test_running_due_catches_up_recurring_and_retires_one_off(self):
+        recurring = self.schedule(100, interval=datetime.timedelta(days=1))
+        one_off = self.schedule(30, is_withdrawal=True)
+        statuses = run_due(batch_size=10)
+        self.assertEqual(statuses, {'success': 4})
+        self.assertEqual(Wallet.objects.get().balance, 270)
+        recurring.refresh_from_db()
+        one_off.refresh_from_db()
+        self.assertEqual(recurring.next_run_at, self.start + datetime.timedelta(days=3))
+        self.assertTrue(recurring.is_active)
+        self.assertFalse(one_off.is_active)
+        self.assertEqual(one_off.last_status, 'success')
+        self.assertEqual(run_due(batch_size=10), {})
+
+    def test_running_due_records_failures(self):
+        overdraft = self.schedule(100, is_withdrawal=True)
+        disabled_wallet = Wallet.create("aaaaaaaa-abd6-406f-8c67-868e814a2436")
+        disabled = self.schedule(100, wallet=disabled_wallet)
+        self.assertEqual(run_due(), {'insufficient': 1, 'disabled': 1})
+        overdraft.refresh_from_db()
+        disabled.refresh_from_db()
+        self.assertEqual(overdraft.last_status, 'insufficient')
+        self.assertEqual(disabled.last_status, 'disabled')
+        self.assertEqual(Transaction.objects.get().is_success, False)
+
+    def test_batch_queries_dont_grow_with_transactions(self):
+        for _ in range(20):
+            self.schedule(10)
+        with CaptureQueriesContext(connection) as queries:
+            run_due(batch_size=50)
+        statements = [query['sql'] for query in queries if 'SAVEPOINT' not in query['sql']]
+        # Select, wallet update, transaction insert, schedule update, and the empty select which ends the run
+        self.assertEqual(len(statements), 5)
+        self.assertEqual(Wallet.objects.get().balance, 200)
+
+    def test_catching_up_is_capped(self):
+        self.start = now() - datetime.timedelta(days=100, hours=1)
+        scheduled = self.schedule(1, interval=datetime.timedelta(days=1))
+        self.assertEqual(run_due(), {'success': 31})
+        scheduled.refresh_from_db()
+        self.assertGreater(scheduled.next_run_at, now())
+        self.assertLess(scheduled.next_run_at, now() + datetime.timedelta(days=1))
+
+    def test_non_positive_interval_runs_once(self):
+        scheduled = self.schedule(100, interval=datetime.timedelta(days=-1))
+        self.assertEqual(run_due(), {'success': 1})
+        scheduled.refresh_from_db()
+        self.assertFalse(scheduled.is_active)
+        self.assertEqual(Wallet.objects.get().balance, 100)
+
+    def test_scheduling_with_negative_or_short_interval_fails(self):
+        client = Client(HTTP_AUTHORIZATION=f'Token {self.wallet.token}')
+        for interval in ['-86400', '0', '00:00:01']:
+            response = client.post(
+                '/api/v1/wallet/scheduled',
+                {'type': 'deposit', 'amount': 100, 'next_run_at': '2030-01-01T00:00:00Z', 'interval': interval})
+            self.assertResponseJsonEqualsTo(
+                response,
+                {
+                    'status': 'fail',
+                    'data': {'interval': [{'message': 'Ensure this value is at least 1 minute.', 'code': 'min_value'}]}
+                }
+            )
+        self.assertFalse(ScheduledTransaction.objects.exists())
+
+    def test_scheduling_in_the_past_fails(self):
+        client = Client(HTTP_AUTHORIZATION=f'Token {self.wallet.token}')
+        response = client.post(
+            '/api/v1/wallet/scheduled',
+            {'type': 'deposit', 'amount': 100, 'next_run_at': '2020-01-01T00:00:00Z', 'interval': '86400'})
+        self.assertResponseJsonEqualsTo(
+            response,
+            {
+                'status': 'fail',
+                'data': {'next_run_at': [{'message': 'Ensure this value is not in the past.', 'code': 'past'}]}
+            }
+        )
+        run_due()
+        self.assertFalse(ScheduledTransaction.objects.exists())
+        self.assertEqual(Wallet.objects.get().balance, 0)
+
+    def test_scheduling_through_api(self):
+        client = Client(HTTP_AUTHORIZATION=f'Token {self.wallet.token}')
+        response = client.post(
+            '/api/v1/wallet/scheduled',
+            {'type': 'withdrawal', 'amount': 100, 'next_run_at': '2030-01-01T00:00:00Z', 'interval': '86400'})
+        scheduled = ScheduledTransaction.objects.get()
+        self.assertEqual(scheduled.interval, datetime.timedelta(days=1))
+        self.assertTrue(scheduled.is_withdrawal)
+        self.assertResponseJsonEqualsTo(
+            response,
+            {
+                'status': 'success',
+                'data': {'scheduled': scheduled.as_response()}
+            }
+        )
+
+
+class ValidationTestCase(AppTestCase):
+    def test_transaction_input_matches_transaction_form(self):
+        reference_id = str(uuid.uuid4())
+        for data in [
+            {'amount': '100', 'reference_id': reference_id},
+            {'amount': ' 100.00 ', 'reference_id': reference_id.replace('-', '').upper()},
+            {'amount': '0', 'reference_id': f' {reference_id} '},
+            {'amount': '-1', 'reference_id': reference_id},
+            {'amount': str(2 ** 63), 'reference_id': reference_id},
+            {'amount': str(2 ** 63 - 1), 'reference_id': reference_id},
+            {'amount': '1.5', 'reference_id': 'not a uuid'},
+            {'amount': 'not a number', 'reference_id': ''},
+            {'amount': '', 'reference_id': '   '},
+            {},
+        ]:
+            form = TransactionForm(data)
+            cleaned, errors = transaction_input(data)
+            if form.is_valid():
+                self.assertEqual(errors, {})
+                self.assertEqual({name: cleaned[name] for name in form.cleaned_data}, form.cleaned_data)
+            else:
+                self.assertEqual(errors, json.loads(form.errors.as_json()))
+
+    def test_customer_xid_must_be_version_4_uuid(self):
+        self.assertEqual(
+            customer_xid({'customer_xid': 'ea0212d3-abd6-406f-8c67-868e814a2436'}),
+            uuid.UUID('ea0212d3-abd6-406f-8c67-868e814a2436'))
+        self.assertEqual(
+            customer_xid({'customer_xid': 'ea0212d3abd6406f8c67868e814a2436'}),
+            uuid.UUID('ea0212d3-abd6-406f-8c67-868e814a2436'))
+        self.assertIsNone(customer_xid({'customer_xid': 'ea0212d3-abd6-106f-8c67-868e814a2436'}))
+        self.assertIsNone(customer_xid({'customer_xid': 'ea0212d3-abd6-406f-cc67-868e814a2436'}))
+        for wrapped in ['{ea0212d3-abd6-406f-8c67-868e814a2436}',
+                        'urn:uuid:ea0212d3-abd6-406f-8c67-868e814a2436',
+                        'ea0212d3abd6-406f-8c67-868e814a-2436',
+                        'ea0212d3-abd6-406f-8c67-868e814a243g',
+                        'ea0212d3_abd6-406f-8c67-868e814a2436',
+                        'ea0212d3abd6406f8c67868e814a243\u0663',
+                        'ea0212d3+bd6406f8c67868e814a2436',
+                        '0xa0212d3abd6406f8c67868e814a2436',
+                        'ea0212d3-abd6-406f-8c67-868e814a-436']:
+            self.assertIsNone(customer_xid({'customer_xid': wrapped}))
+        # As UUID_RE did, any of the dashes may be left out
+        for partly_dashed in ['ea0212d3-abd6406f-8c67-868e814a2436', 'EA0212D3abd6-406f8c67868e814a2436']:
+            self.assertEqual(
+                customer_xid({'customer_xid': partly_dashed}), uuid.UUID('ea0212d3-abd6-406f-8c67-868e814a2436'))
+        self.assertIsNone(customer_xid({}))
+
+    def test_json_bodies_are_accepted(self):
+        client = Client()
+        response = client.post(
+            '/api/v1/init', {'customer_xid': 'ea0212d3-abd6-406f-8c67-868e814a2436'}, content_type='application/json')
+        self.assertEqual(response.json()['status'], 'success')
+        wallet = Wallet.objects.get()
+        wallet.enable()
+        client = Client(HTTP_AUTHORIZATION=f'Token {wallet.token}')
+        response = client.post(
+            '/api/v1/wallet/deposits',
+            {'amount': 100, 'reference_id': str(uuid.uuid4())},
+            content_type='application/json')
+        self.assertEqual(response.json()['status'], 'success')
+        self.assertEqual(Wallet.objects.get().balance, 100)
+        response = client.post(
+            '/api/v1/wallet/deposits', {'amount': True}, content_type='application/json')
+        self.assertResponseJsonEqualsTo(
+            response,
+            {
+                'status': 'fail',
+                'data': {"amount": [{"message": "Enter a whole number.", "code": "invalid"}],
+                         "reference_id": [{"message": "This field is required.", "code": "required"}]}
+            }
+        )
+
+
+class MoneyTestCase(AppTestCase):
+    def setUp(self):
+        self.wallet = Wallet.create("ea0212d3-abd6-406f-8c67-868e814a2436")
+        self.wallet.enable()
+
+    def test_balance_beyond_32_bits(self):
+        self.wallet.deposit(2 ** 40, uuid.uuid4())
+        self.wallet.deposit(2 ** 40, uuid.uuid4())
+        self.assertEqual(Wallet.objects.get().balance, 2 ** 41)
+
+    def test_amount_beyond_64_bits_fails(self):
+        client = Client(HTTP_AUTHORIZATION=f'Token {self.wallet.token}')
+        response = client.post('/api/v1/wallet/deposits', {'amount': 2 ** 63, 'reference_id': uuid.uuid4()})
+        self.assertResponseJsonEqualsTo(
+            response,
+            {
+                'status': 'fail',
+                'data': {'amount': [{'message': 'Ensure this value is less than or equal to 9223372036854775807.',
+                                     'code': 'max_value'}]}
+            }
+        )
+
+    def test_deposit_taking_balance_beyond_64_bits_fails(self):
+        client = Client(HTTP_AUTHORIZATION=f'Token {self.wallet.token}')
+        for currency in ['IDR', 'USD']:
+            response = client.post(
+                '/api/v1/wallet/deposits', {'amount': 2 ** 62, 'reference_id': uuid.uuid4(), 'currency': currency})
+            self.assertEqual(response.json()['status'], 'success')
+            response = client.post(
+                '/api/v1/wallet/deposits', {'amount': 2 ** 62, 'reference_id': uuid.uuid4(), 'currency': currency})
+            self.assertResponseJsonEqualsTo(
+                response,
+                {
+                    'status': 'fail',
+                    'data': {'wallet': 'Balance limit exceeded'}
+                }
+            )
+        self.assertEqual(Wallet.objects.get().balance, 2 ** 62)
+        self.assertEqual(SubBalance.objects.get().balance, 2 ** 62)
+        self.assertEqual(Transaction.objects.count(), 2)
+
+    def test_batch_deposit_taking_balance_beyond_64_bits_fails(self):
+        self.wallet.deposit(2 ** 62, uuid.uuid4())
+        outcomes = self.wallet.post_batch([(2 ** 62, False, uuid.uuid4()), (1, False, uuid.uuid4())])
+        self.assertEqual(outcomes, ['over_limit', 'success'])
+        self.assertEqual(Wallet.objects.get().balance, 2 ** 62 + 1)
+        with self.assertRaises(BalanceLimitExceeded):
+            self.wallet.deposit(2 ** 63 - 1, uuid.uuid4())
+
+    def test_other_currencies_go_to_sub_balances(self):
+        self.assertEqual(self.wallet.currency, 'IDR')
+        client = Client(HTTP_AUTHORIZATION=f'Token {self.wallet.token}')
+        response = client.post(
+            '/api/v1/wallet/deposits', {'amount': 500, 'reference_id': uuid.uuid4(), 'currency': 'usd'})
+        self.assertEqual(response.json()['data']['deposit']['currency'], 'USD')
+        response = client.post(
+            '/api/v1/wallet/withdrawal', {'amount': 501, 'reference_id': uuid.uuid4(), 'currency': 'USD'})
+        self.assertEqual(response.json()['data'], {'wallet': 'Insufficient balance'})
+        response = client.post(
+            '/api/v1/wallet/withdrawal', {'amount': 200, 'reference_id': uuid.uuid4(), 'currency': 'USD'})
+        self.assertEqual(response.json()['status'], 'success')
+        self.assertEqual(SubBalance.objects.get().balance, 300)
+        self.assertEqual(Wallet.objects.get().balance, 0)
+        with self.assertNumQueries(1):
+            response = client.get('/api/v1/wallet', {})
+        self.assertEqual(response.json()['data']['wallet']['balances'], {'IDR': 0, 'USD': 300})
+        self.assertEqual(Wallet.objects.get().balances(), {'IDR': 0, 'USD': 300})
+
+    def test_withdrawing_from_sub_balance_checks_it_once(self):
+        self.wallet.deposit(500, uuid.uuid4(), 'USD')
+        with CaptureQueriesContext(connection) as queries:
+            self.wallet.withdraw(200, uuid.uuid4(), 'USD')
+        statements = [query['sql'] for query in queries if 'SAVEPOINT' not in query['sql']]
+        # The conditional update, then the transaction insert
+        self.assertEqual(len(statements), 2)
+        with self.assertRaises(InsufficientBalance):
+            self.wallet.withdraw(301, uuid.uuid4(), 'USD')
+
+    def test_unknown_currency_fails(self):
+        client = Client(HTTP_AUTHORIZATION=f'Token {self.wallet.token}')
+        response = client.post(
+            '/api/v1/wallet/deposits', {'amount': 500, 'reference_id': uuid.uuid4(), 'currency': 'XYZ'})
+        self.assertResponseJsonEqualsTo(
+            response,
+            {
+                'status': 'fail',
+                'data': {'currency': [{'message': 'Select a valid choice. XYZ is not one of the available choices.',
+                                       'code': 'invalid_choice'}]}
+            }
+        )
+
+    def test_reporting_totals_per_currency(self):
+        self.wallet.deposit(1000, uuid.uuid4())
+        self.wallet.withdraw(300, uuid.uuid4())
+        self.wallet.deposit(250, uuid.uuid4(), 'USD')
+        other = Wallet.create("aaaaaaaa-abd6-406f-8c67-868e814a2436")
+        other.deposit(7, uuid.uuid4(), 'JPY')
+        with self.assertNumQueries(2):
+            balances = balances_by_currency()
+        self.assertEqual(balances, {'IDR': 700, 'USD': 250, 'JPY': 7})
+        with self.assertNumQueries(1):
+            flows = flows_by_currency()
+        self.assertEqual(flows, {'IDR': (1000, 300), 'USD': (250, 0), 'JPY': (7, 0)})
+
+    def test_reporting_totals_beyond_64_bits(self):
+        other = Wallet.create("aaaaaaaa-abd6-406f-8c67-868e814a2436")
+        for wallet in [self.wallet, other]:
+            wallet.deposit(2 ** 62 + 5, uuid.uuid4())
+            wallet.deposit(2 ** 62 + 5, uuid.uuid4(), 'USD')
+            wallet.withdraw(2 ** 62, uuid.uuid4())
+            wallet.deposit(2 ** 62 + 7, uuid.uuid4())
+        self.assertEqual(balances_by_currency(), {'IDR': 2 ** 63 + 24, 'USD': 2 ** 63 + 10})
+        self.assertEqual(flows_by_currency(), {'IDR': (2 ** 64 + 24, 2 ** 63), 'USD': (2 ** 63 + 10, 0)})
+
+    def test_converting_totals_between_minor_units(self):
+        # 2.50 USD and 100 JPY at 1 JPY = 0.0065 USD come to 3.15 USD
+        self.assertEqual(convert_totals({'USD': 250, 'JPY': 100}, {'JPY': '0.0065'}, 'USD'), 315)
+        # 1.000 KWD = 3.25 USD
+        self.assertEqual(convert_totals({'KWD': 1000}, {'KWD': '3.25'}, 'USD'), 325)
+
+
+WSGI_WORKER = '''
+import os
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'bridgechallenge.settings')
+from django.conf import settings
+settings.DATABASES['default']['NAME'] = {database!r}
+import bridgechallenge.wsgi
+from django.core.signals import request_started
+from django.db import connection
+request_started.send(sender=None)
+print(connection.connection is not None)
+'''
+
+
+class StartupTestCase(AppTestCase):
+    def test_parsing_importtime_output(self):
+        output = (
+            'import time: self [us] | cumulative | imported package\n'
+            'import time:       120 |        120 |   _io\n'
+            'import time:      1503 |      20711 | django.core.wsgi\n'
+            'some other line\n'
+        )
+        self.assertEqual(parse_importtime(output), [('_io', 120, 120), ('django.core.wsgi', 1503, 20711)])
+
+    def test_profiling_startup_from_another_directory(self):
+        out = StringIO()
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as elsewhere:
+            os.chdir(elsewhere)
+            try:
+                call_command('profile_startup', '--top', '1', '--no-warm-up', stdout=out)
+            finally:
+                os.chdir(cwd)
+        self.assertIn('modules imported', out.getvalue())
+
+    def test_warming_up_runs_the_authentication_query(self):
+        with self.assertNumQueries(1):
+            warm_up()
+
+    def test_warmed_up_connection_serves_the_first_request(self):
+        with tempfile.TemporaryDirectory() as directory:
+            existing = os.path.join(directory, 'existing.sqlite3')
+            sqlite3.connect(existing).close()
+            self.assertEqual(self.start_wsgi_worker(existing), 'True')
+            missing = os.path.join(directory, 'missing.sqlite3')
+            self.assertEqual(self.start_wsgi_worker(missing), 'False')
+            self.assertFalse(os.path.exists(missing))
+
+    def start_wsgi_worker(self, database):
+        '''Whether a connection is open once the first request started, in a worker using the database'''
+        result = subprocess.run([sys.executable, '-c', WSGI_WORKER.format(database=database)],
+                                capture_output=True, text=True, cwd=settings.BASE_DIR, check=True)
+        return result.stdout.strip()
+
+
+class StatementTestCase(AppTestCase):
+    def setUp(self):
+        self.output_dir = tempfile.TemporaryDirectory()
+        self.start = datetime.datetime(2022, 4, 1, tzinfo=datetime.timezone.utc)
+        self.end = datetime.datetime(2022, 5, 1, tzinfo=datetime.timezone.utc)
+        self.wallets = []
+        for _ in range(3):
+            wallet = Wallet.create(uuid.uuid4())
+            wallet.enable()
+            self.wallets.append(wallet)
+        first, second, _ = self.wallets
+        self.transact(first, 100, '2022-03-15')
+        self.transact(first, 30, '2022-04-02', is_withdrawal=True)
+        self.transact(first, 5, '2022-04-03', currency='USD')
+        self.transact(first, 1000, '2022-05-01')
+        self.transact(second, 40, '2022-04-10')
+
+    def tearDown(self):
+        self.output_dir.cleanup()
+
+    def transact(self, wallet, amount, day, is_withdrawal=False, currency='IDR'):
+        transaction = Transaction.objects.create(
+            wallet=wallet, is_success=True, is_withdrawal=is_withdrawal, reference_id=uuid.uuid4(),
+            amount=amount, currency=currency)
+        Transaction.objects.filter(pk=transaction.pk).update(
+            transacted_at=datetime.datetime.fromisoformat(day).replace(tzinfo=datetime.timezone.utc))
+
+    def statements(self):
+        lines = []
+        for first, last in partitions(2):
+            with open(partition_path(self.output_dir.name, first, last)) as statements:
+                lines.extend(json.loads(line) for line in statements)
+        return lines
+
+    def generate(self):
+        return sum(
+            generate_partition(first, last, self.start, self.end, self.output_dir.name)
+            for first, last in partitions(2))
+
+    def test_generating_statements(self):
+        self.assertEqual(len(partitions(2)), 2)
+        self.assertEqual(self.generate(), 3)
+        first, second, third = self.statements()
+        self.assertEqual(first['balances'], {'IDR': {'opening': 100, 'closing': 70},
+                                             'USD': {'opening': 0, 'closing': 5}})
+        self.assertEqual([row['amount'] for row in first['transactions']], [30, 5])
+        self.assertEqual(second['balances'], {'IDR': {'opening': 0, 'closing': 40}})
+        self.assertEqual(third['balances'], {'IDR': {'opening': 0, 'closing': 0}})
+        self.assertEqual(third['transactions'], [])
+        # Nothing is left to do on a second run
+        self.assertEqual(self.generate(), 0)
+
+    def test_opening_balance_after_flows_beyond_64_bits(self):
+        _, _, third = self.wallets
+        # The database may add them up in any order
+        self.transact(third, 2 ** 63 - 1, '2022-01-01', currency='USD')
+        self.transact(third, 2 ** 63 - 1, '2022-03-01', currency='USD')
+        self.transact(third, 2 ** 63 - 1, '2022-02-01', currency='USD', is_withdrawal=True)
+        self.generate()
+        self.assertEqual(self.statements()[2]['balances'], {'IDR': {'opening': 0, 'closing': 0},
+                                                            'USD': {'opening': 2 ** 63 - 1, 'closing': 2 ** 63 - 1}})
+
+    def test_resuming_interrupted_partition(self):
+        first, last = partitions(2)[0]
+        path = partition_path(self.output_dir.name, first, last)
+        generate_partition(first, last, self.start, self.end, self.output_dir.name)
+        with open(path) as statements:
+            written = statements.readlines()
+        os.remove(path)
+        # As if interrupted while writing the second statement
+        with open(path + '.partial', 'w') as partial:
+            partial.write(written[0] + written[1][:10])
+        self.assertEqual(generate_partition(first, last, self.start, self.end, self.output_dir.name), 1)
+        with open(path) as statements:
+            self.assertEqual(statements.readlines(), written)
+        self.assertFalse(os.path.exists(path + '.partial'))
+
+    def test_plan_is_kept_across_runs(self):
+        ranges = plan(self.output_dir.name, 2, self.start, self.end)
+        self.assertEqual(ranges, partitions(2))
+        first, last = ranges[0]
+        generate_partition(first, last, self.start, self.end, self.output_dir.name)
+        Wallet.objects.filter(pk=self.wallets[0].pk).delete()
+        newest = Wallet.create(uuid.uuid4())
+        self.assertNotEqual(partitions(2), ranges)
+        self.assertEqual(
+            plan(self.output_dir.name, 2, self.start, self.end), [*ranges, (ranges[-1][1] + 1, newest.pk)])
+        self.assertEqual(
+            plan(self.output_dir.name, 2, self.start, self.end), [*ranges, (ranges[-1][1] + 1, newest.pk)])
+        with self.assertRaises(ValueError):
+            plan(self.output_dir.name, 2, self.end, self.end + datetime.timedelta(days=30))
+
+
+class StatementCommandTestCase(TransactionTestCase):
+    def test_generating_statements_in_worker_processes(self):
+        for _ in range(5):
+            Wallet.create(uuid.uuid4()).deposit(10, uuid.uuid4())
+        month = now().strftime('%Y-%m')
+        with tempfile.TemporaryDirectory() as output_dir:
+            out = StringIO()
+            call_command('generate_statements', '--month', month, '--output-dir', output_dir,
+                         '--partitions', '3', '--workers', '2', stdout=out)
+            self.assertIn('5 statements written', out.getvalue())
+            statements = []
+            for name in sorted(os.listdir(os.path.join(output_dir, month))):
+                if name == 'manifest.json':
+                    continue
+                with open(os.path.join(output_dir, month, name)) as lines:
+                    statements.extend(json.loads(line) for line in lines)
+        self.assertEqual([statement['balances']['IDR']['closing'] for statement in statements], [10] * 5)
@@ -7,4 +7,6 @@ urlpatterns = [
     path('wallet', views.WalletView.as_view()),
     path('wallet/deposits', views.WalletDepositView.as_view()),
     path('wallet/withdrawal', views.WalletWithdrawalView.as_view()),
+    path('wallet/scheduled', views.WalletScheduledView.as_view()),
+    path('metrics', views.MetricsView.as_view()),
 ]
\ No newline at end of file
@@ -1,19 +1,18 @@
-import json
-import re
-
 from django.http import JsonResponse
 from django.views import View
 
-from app.forms import TransactionForm
-from app.models import Wallet
-
-UUID_RE = re.compile('^[a-f0-9]{8}-?[a-f0-9]{4}-?4[a-f0-9]{3}-?[89ab][a-f0-9]{3}-?[a-f0-9]{12}\Z', re.I)
+from app import metrics
+from app.forms import ScheduledTransactionForm
+from app.models import BalanceLimitExceeded, InsufficientBalance, ScheduledTransaction, Wallet, WalletConflict
+from app.routers import is_reading_from_replica, reading_from_replica, record_write, wrote_recently
+from app.state import WalletState, status_registry
+from app.validation import customer_xid, request_data, transaction_input
 
 
 class CreateWallet(View):
     def post(self, request):
-        customer_id = request.POST.get('customer_xid', '')
-        if not UUID_RE.match(customer_id):
+        customer_id = customer_xid(request_data(request))
+        if customer_id is None:
             return JsonResponse({
                 'status': 'fail',
                 'data': {'customer_xid': 'customer_xid must match format for uuid'}
@@ -24,14 +23,30 @@ class CreateWallet(View):
                 'data': {'customer_xid': 'Customer id exists'}
             })
         wallet = Wallet.create(customer_id)
+        record_write(wallet.token)
         return JsonResponse({
             'status': 'success',
             'data': {'token': wallet.token}
         })
 
 
+class MetricsView(View):
+    def get(self, request):
+        return JsonResponse({
+            'status': 'success',
+            'data': {'metrics': metrics.shared_snapshot()}
+        })
+
+
 class AuthenticatedWalletView(View):
     wallet = None
+    token = None
+    # Handlers which modify the wallet get a Wallet, the others make do with a WalletState
+    writing_methods = ()
+    # Handlers which only fail on a disabled wallet, these may be answered from the status registry
+    enabled_only_methods = ()
+    # Handlers which only read, these may be served from a replica
+    replica_methods = ()
 
     def success(self, data):
         return JsonResponse({
@@ -48,15 +63,40 @@ class AuthenticatedWalletView(View):
             status=code)
 
     def dispatch(self, request, *args, **kwargs):
-        maybe_token = request.headers.get('Authorization', '').replace('Token ', '')
+        self.token = request.headers.get('Authorization', '').replace('Token ', '')
+        method = request.method.lower()
+        if method in self.enabled_only_methods and status_registry.is_disabled(self.token):
+            return self.failure({'wallet': 'Wallet is disabled'})
+        if method in self.replica_methods and not wrote_recently(self.token):
+            with reading_from_replica():
+                return self.authenticated_dispatch(request, method, *args, **kwargs)
+        response = self.authenticated_dispatch(request, method, *args, **kwargs)
+        if method in self.writing_methods and response.status_code == 200:
+            record_write(self.token)
+        return response
+
+    def authenticated_dispatch(self, request, method, *args, **kwargs):
         try:
-            self.wallet = Wallet.objects.get(token=maybe_token)
+            if method in self.writing_methods:
+                self.wallet = Wallet.objects.get(token=self.token)
+            else:
+                self.wallet = WalletState.for_token(self.token)
         except Wallet.DoesNotExist:
             return self.failure({'token': 'Invalid token'})
-        return super().dispatch(request, *args, **kwargs)
+        # A replica may lag behind, and the registry would keep its answer
+        if not is_reading_from_replica():
+            status_registry.record(self.token, self.wallet.is_enabled())
+        try:
+            return super().dispatch(request, *args, **kwargs)
+        except WalletConflict:
+            return self.failure({'wallet': 'Wallet is being changed by another request, try again'}, code=409)
 
 
 class WalletView(AuthenticatedWalletView):
+    writing_methods = ('patch', 'post')
+    enabled_only_methods = ('get',)
+    replica_methods = ('get',)
+
     def get(self, request, *args, **kwargs):
         if not self.wallet.is_enabled():
             return self.failure({'wallet': 'Wallet is disabled'})
@@ -64,43 +104,67 @@ class WalletView(AuthenticatedWalletView):
 
     def patch(self, request, *args, **kwargs):
         self.wallet.disable()
+        status_registry.record(self.token, False)
         return self.success({'wallet': self.wallet.as_response()})
 
     def post(self, request, *args, **kwargs):
         if self.wallet.is_enabled():
             return self.failure({'wallet': 'Already enabled'})
         self.wallet.enable()
+        status_registry.record(self.token, True)
         return self.success({'wallet': self.wallet.as_response()})
 
 
 class WalletTransactionView(AuthenticatedWalletView):
+    writing_methods = ('post',)
+    enabled_only_methods = ('post',)
+
     def post(self, request, *args, **kwargs):
-        form = TransactionForm(request.POST)
         if not self.wallet.is_enabled():
             return self.failure({'wallet': 'Wallet is disabled'})
-        if not form.is_valid():
-            return self.failure(json.loads(form.errors.as_json()))
+        cleaned, errors = transaction_input(request_data(request))
+        if errors:
+            return self.failure(errors)
         else:
-            return self.handle(form.cleaned_data['amount'], form.cleaned_data['reference_id'])
+            return self.handle(cleaned['amount'], cleaned['reference_id'], cleaned['currency'])
 
-    def handle(self, amount, reference_id):
+    def handle(self, amount, reference_id, currency):
         raise NotImplemented
 
 
 class WalletDepositView(WalletTransactionView):
-    def handle(self, amount, reference_id):
-        deposit = self.wallet.deposit(amount, reference_id)
+    def handle(self, amount, reference_id, currency):
+        try:
+            deposit = self.wallet.deposit(amount, reference_id, currency)
+        except BalanceLimitExceeded:
+            return self.failure({'wallet': 'Balance limit exceeded'})
         return self.success({'deposit': deposit.as_response()})
 
 
 class WalletWithdrawalView(WalletTransactionView):
-    def handle(self, amount, reference_id):
-        if not self.wallet.can_withdraw(amount):
+    def handle(self, amount, reference_id, currency):
+        if not self.wallet.can_withdraw(amount, currency):
+            return self.failure({'wallet': 'Insufficient balance'})
+        try:
+            withdrawal = self.wallet.withdraw(amount, reference_id, currency)
+        except InsufficientBalance:
             return self.failure({'wallet': 'Insufficient balance'})
-        withdrawal = self.wallet.withdraw(amount, reference_id)
         return self.success({'withdrawal': withdrawal.as_response()})
 
 
+class WalletScheduledView(AuthenticatedWalletView):
+    enabled_only_methods = ('post',)
 
-
-
+    def post(self, request, *args, **kwargs):
+        form = ScheduledTransactionForm(request_data(request))
+        if not self.wallet.is_enabled():
+            return self.failure({'wallet': 'Wallet is disabled'})
+        if not form.is_valid():
+            return self.failure(form.errors.get_json_data())
+        scheduled = ScheduledTransaction.objects.create(
+            wallet_id=self.wallet.pk,
+            is_withdrawal=form.cleaned_data['type'] == 'withdrawal',
+            amount=form.cleaned_data['amount'],
+            next_run_at=form.cleaned_data['next_run_at'],
+            interval=form.cleaned_data['interval'])
+        return self.success({'scheduled': scheduled.as_response()})
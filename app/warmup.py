@@ -0,0 +1,75 @@
+'''
+Gets a freshly started worker to the state it is in after serving a few requests,
+so the first wallet request isn't the one paying for it.
+Database connections belong to the process and thread which opened them, and outlive a request only for
+CONN_MAX_AGE. If the server imports the application before forking workers, turn off WARM_UP_ON_START and call
+warm_up() from its post fork hook.
+'''
+import logging
+import os
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DatabaseError, connections
+from django.urls import URLResolver, get_resolver
+
+from app.models import Wallet
+from app.state import WalletState
+
+logger = logging.getLogger(__name__)
+
+
+def _routes(patterns, prefix='/'):
+    for pattern in patterns:
+        route = prefix + str(pattern.pattern)
+        if isinstance(pattern, URLResolver):
+            yield from _routes(pattern.url_patterns, route)
+        elif '<' not in route and '^' not in route:
+            yield route
+
+
+def _missing_sqlite_file(alias):
+    '''Connecting would create an empty database file in its place'''
+    database = connections[alias].settings_dict
+    return (database['ENGINE'] == 'django.db.backends.sqlite3' and not connections[alias].is_in_memory_db()
+            and not os.path.exists(database['NAME']))
+
+
+def _warm_up_databases():
+    aliases = ['default', *settings.DATABASE_REPLICAS]
+    missing = [alias for alias in aliases if _missing_sqlite_file(alias)]
+    if missing:
+        logger.warning('Not warming up the databases, there is no SQLite file for %s', ', '.join(missing))
+        return
+    try:
+        for alias in aliases:
+            connections[alias].ensure_connection()
+        # Build and run the authentication query once, it matches nothing
+        WalletState.for_token('')
+    except Wallet.DoesNotExist:
+        pass
+    except DatabaseError:
+        # Requests will report this properly, the worker should still come up
+        logger.warning('Could not warm up the database', exc_info=True)
+
+
+def warm_up(databases=True):
+    '''
+    databases=False leaves out connecting to the databases and querying them, for servers which won't run
+    requests in this thread.
+    '''
+    started = time.perf_counter()
+
+    # Resolving compiles the URL patterns and imports the views behind them
+    resolver = get_resolver()
+    for route in _routes(resolver.url_patterns):
+        resolver.resolve(route)
+
+    # The first use of a cache backend connects and imports it
+    cache.get('warm-up')
+
+    if databases:
+        _warm_up_databases()
+
+    logger.info('Warmed up in %.1fms', (time.perf_counter() - started) * 1000)
@@ -9,8 +9,15 @@ https://docs.djangoproject.com/en/4.0/howto/deployment/asgi/
 
 import os
 
+from django.conf import settings
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'bridgechallenge.settings')
 
 application = get_asgi_application()
+
+if settings.WARM_UP_ON_START:
+    from app.warmup import warm_up
+    # Django runs the sync code of each ASGI request in a thread of its own, so a database connection opened here,
+    # or in any other thread, would never serve a request
+    warm_up(databases=False)
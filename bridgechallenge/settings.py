@@ -78,7 +78,40 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
-    }
+        # A file rather than the in memory default, so the stress tests can hit it from other processes
+        'TEST': {'NAME': BASE_DIR / 'test_db.sqlite3'},
+        # Keep connections open between requests, so the one opened by app.warmup serves the first request
+        'CONN_MAX_AGE': 60,
+    },
+    # Point this at a replica of the default database. Locally a copy of db.sqlite3 will do.
+    'replica': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': BASE_DIR / 'db.sqlite3',
+        'TEST': {'MIRROR': 'default'},
+        'CONN_MAX_AGE': 60,
+    },
+}
+
+DATABASE_ROUTERS = ['app.routers.ReplicaRouter']
+
+# Aliases of the databases which may serve wallet reads, add 'replica' to use it.
+# Needs CACHES to be shared by the workers, see below.
+DATABASE_REPLICAS = []
+
+# How long reads of a wallet stay on the primary after it was written to
+REPLICA_STICKY_SECONDS = 5
+
+# Cache
+# https://docs.djangoproject.com/en/4.0/topics/cache/
+
+# Each worker has its own local memory cache. Replace it with one the workers share, e.g. Redis or Memcached,
+# before using DATABASE_REPLICAS: the reads which follow a write are kept on the primary through the cache, so with
+# a cache per worker a write made on one worker is read stale from a replica on another. The check app.E001
+# refuses that. The sums of GET /api/v1/metrics likewise only cover the workers sharing the cache.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
 }
 
 
@@ -122,3 +155,18 @@ STATIC_URL = 'static/'
 # https://docs.djangoproject.com/en/4.0/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+# Keep an in process record of which wallets are disabled, see app.state.WalletStatusRegistry.
+# Workers don't share it, so leave it off unless wallets are rarely re-enabled.
+WALLET_STATUS_REGISTRY = False
+
+# How long a wallet found disabled is turned away without a query, hence how long a wallet re-enabled by
+# another worker may still be refused by this one
+WALLET_STATUS_REGISTRY_SECONDS = 5
+
+# Currency of new wallets, and of transactions which don't name one. See app.money.MINOR_UNITS for the others.
+WALLET_CURRENCY = 'IDR'
+
+# Prime URL resolvers, caches and, under WSGI, database connections before the worker takes requests,
+# see app.warmup
+WARM_UP_ON_START = True